@@ -1,4 +1,5 @@
 from inspect import isgeneratorfunction
+from time import time
 from decorator import decorator
 from peewee import chunked, IntegrityError, SqliteDatabase
 from playhouse.sqlite_ext import SqliteExtDatabase
@@ -60,7 +61,7 @@ def task(function, *args, **kwargs):
 
                 try:
                     pk = getattr(result, result._meta.primary_key.name, None)
-                except:
+                except AttributeError:
                     None
                 else:
                     if pk is not None:
@@ -84,8 +85,10 @@ def task(function, *args, **kwargs):
             
             else:
                 if timer.check_point or n_results_since_last_check_point >= result_frequency:
-                    with timer.pause():
-
+                    # Time spent here is excluded from the task timing. We track it inline rather
+                    # than creating a context manager (and a new `Timer`) at every check point.
+                    t_paused = time()
+                    try:
                         # Add estimated overheads to each result.
                         timer.add_overheads(results)
                         try:
@@ -102,6 +105,8 @@ def task(function, *args, **kwargs):
                         log.debug(f"Yielded {len(results)} results")
                         results = [] # avoid memory leak, which can happen if we are running
                         n_results_since_last_check_point = 0
+                    finally:
+                        timer._time_paused += time() - t_paused
 
     # It is only at this point that we know:
     # - how many results were created
@@ -143,7 +148,9 @@ def _bulk_insert(results, batch_size, re_raise_exceptions=False):
         model.create_table()
         
     try:
-        if isinstance(database, (SqliteExtDatabase, SqliteDatabase)):
+        # SQLite >= 3.35 supports RETURNING, so peewee can bulk insert and still give us the ids.
+        # Only fall back to one INSERT per result when that is not available.
+        if isinstance(database, (SqliteExtDatabase, SqliteDatabase)) and not getattr(database, "returning_clause", False):
             # Do inserts in batches, but make sure that we get the RETURNING id behaviour so that there
             # is consistency in expectations between postgresql/sqlite
             for i, _result in enumerate(database.batch_commit(results, batch_size)):
@@ -2,17 +2,25 @@ import concurrent
 import subprocess
 import numpy as np
 
-from collections import OrderedDict
-from peewee import chunked, Case, fn, JOIN, IntegrityError
+from collections import OrderedDict, deque
+from operator import itemgetter
+from peewee import chunked, Case, JOIN, IntegrityError
 from typing import Optional
 from tqdm import tqdm
 from astropy.table import Table
 from astra.models.apogee import ApogeeVisitSpectrum, Spectrum, ApogeeVisitSpectrumInApStar, ApogeeCoaddedSpectrumInApStar
 from astra.models.source import Source
-from astra.models.base import database
 from astra.utils import expand_path, flatten, log
 
-from astra.migrations.utils import enumerate_new_spectrum_pks, upsert_many
+from astra.migrations.utils import (
+    enumerate_new_spectrum_pks, 
+    upsert_many, 
+    copy_upsert_many, 
+    update_many, 
+    insert_many_ignoring_conflicts,
+    get_max_parameters
+)
+from astra.migrations.sdss5db.utils import get_approximate_rows
 
 
 def copy_doppler_results_from_visit_to_coadd(batch_size: Optional[int] = 100, limit: Optional[int] = None):
@@ -75,44 +83,42 @@ def copy_doppler_results_from_visit_to_coadd(batch_size: Optional[int] = 100, li
 
 
 def migrate_apogee_obj_from_source(batch_size: Optional[int] = 100, limit: Optional[int] = None):
+    """
+    Set the `obj` of APOGEE visit spectra from the SDSS-4 APOGEE identifier of their source.
+
+    This is done with a single `UPDATE ... FROM` statement in the database.
+
+    :param batch_size: [optional]
+        Unused. This is kept for consistency with other migration functions.
+
+    :param limit: [optional]
+        Limit the number of spectra to update.
 
+    :returns:
+        The number of spectra updated.
+    """
+    where = (
+        ApogeeVisitSpectrum.obj.is_null()
+    &   ApogeeVisitSpectrum.healpix.is_null() # don't overwrite the apogee_drp-computed healpix, even if it's wrong
+    &   Source.sdss4_apogee_id.is_null(False)
+    )
     q = (
         ApogeeVisitSpectrum
-        .select(
-            ApogeeVisitSpectrum.spectrum_pk,
-            Source.sdss4_apogee_id
-        )
-        .join(Source, on=(ApogeeVisitSpectrum.source_id == Source.id))
-        .where(
-            ApogeeVisitSpectrum.obj.is_null()
-        &   ApogeeVisitSpectrum.healpix.is_null() # don't overwrite the apogee_drp-computed healpix, even if it's wrong
-        &   Source.sdss4_apogee_id.is_null(False)
-        )
-        .tuples()
+        .update(obj=Source.sdss4_apogee_id)
+        .from_(Source)
+        .where((ApogeeVisitSpectrum.source == Source.pk) & where)
     )
-
-    total = limit or q.count()
-    with tqdm(total=total, desc="Updating", unit="spectra") as pb:
-        for chunk in chunked(q.iterator(), batch_size):
-            objs = { spectrum_pk: obj for spectrum_pk, obj in chunk }
-            q = (
-                ApogeeVisitSpectrum
-                .select()
-                .where(ApogeeVisitSpectrum.spectrum_pk.in_(list(objs.keys())))
-            )
-            batch = list(q)
-            for spectrum in batch:
-                spectrum.obj = objs[spectrum.spectrum_pk]
-            
-            pb.update(
+    if limit is not None:
+        q = q.where(
+            ApogeeVisitSpectrum.pk.in_(
                 ApogeeVisitSpectrum
-                .bulk_update(
-                    batch,
-                    fields=[ApogeeVisitSpectrum.obj]
-                )
+                .select(ApogeeVisitSpectrum.pk)
+                .join(Source)
+                .where(where)
+                .limit(limit)
             )
-
-    return pb.n
+        )
+    return q.execute()
 
 
 def _migrate_apstar_metadata(
@@ -292,10 +298,14 @@ def fix_version_id_edge_cases(version_ids=(13, )):
                 log.info(f"Failed to update {source} with sdss_id={source.sdss_id}. Updating dependencies.")
                 existing_source_pk = Source.get(sdss_id=source.sdss_id).pk
                 for expr, field in source.dependencies():
-                    for item in field.model.select().where(expr):
-                        log.info(f"\t{field.model} {item} source_pk={existing_source_pk}")
-                        item.source_pk = existing_source_pk
-                        item.save()
+                    # Only update the foreign key column, rather than re-saving every dependent row.
+                    n_updated = (
+                        field.model
+                        .update({field: existing_source_pk})
+                        .where(expr)
+                        .execute()
+                    )
+                    log.info(f"\t{field.model}: updated {n_updated} rows to source_pk={existing_source_pk}")
                 
                 log.info(f"Deleting {source}")
                 source.delete_instance()
@@ -380,48 +390,60 @@ def migrate_sdss4_dr17_apogee_spectra_from_sdss5_catalogdb(batch_size: Optional[
         .dicts()
     )
 
+    # Targeting keys to merge when a star appears more than once.
+    flag_keys = (
+        "sdss4_apogee_member_flags",
+        "sdss4_apogee_target1_flags",
+        "sdss4_apogee_target2_flags",
+        "sdss4_apogee2_target1_flags",
+        "sdss4_apogee2_target2_flags",
+        "sdss4_apogee2_target3_flags",
+    )
     source_data = {}
     for row in tqdm(q.iterator(), total=1):
-        source_key = row["sdss4_apogee_id"]            
-        if source_key in source_data:
-            # Take the minimum sdss_id
-            source_data[source_key]["sdss_id"] = min(source_data[source_key]["sdss_id"], row["sdss_id"])
-            for key, value in row.items():
-                # Merge any targeting keys
-                if key.startswith("sdss4_apogee") and key.endswith("_flags"):
-                    source_data[source_key][key] |= value                    
-        else:
+        source_key = row["sdss4_apogee_id"]
+        existing = source_data.get(source_key, None)
+        if existing is None:
             source_data[source_key] = row
+        else:
+            # Take the minimum sdss_id
+            existing["sdss_id"] = min(existing["sdss_id"], row["sdss_id"])
+            for key in flag_keys:
+                existing[key] |= row[key]
 
     # Assign the Sun to have SDSS_ID = 0, because it's very special to me.
     source_data["VESTA"]["sdss_id"] = 0
                             
-    # Upsert the sources
-    with database.atomic():
-        with tqdm(desc="Upserting sources", total=len(source_data)) as pb:
-            for chunk in chunked(source_data.values(), batch_size):
-                (
-                    Source
-                    .insert_many(chunk)
-                    .on_conflict_ignore()
-                    .execute()
-                )
-                pb.update(min(batch_size, len(chunk)))
-                pb.refresh()
-
-    log.info(f"Getting data for sources")
-    q = (
-        Source
-        .select(
-            Source.pk,
-            Source.sdss_id,
+    # Upsert the sources, and keep the primary keys of the sources that were inserted.
+    lookup_source_pk_given_sdss_id = dict(
+        copy_upsert_many(
+            Source,
+            (Source.sdss_id, Source.pk),
+            source_data.values(),
+            batch_size,
+            desc="Upserting sources"
         )
-        .tuples()
-        .iterator()
     )
 
+    # Sources that already existed are not returned by the upsert, so only look those up.
+    log.info(f"Getting data for existing sources")
+    existing_sdss_ids = (
+        { attrs["sdss_id"] for attrs in source_data.values() } 
+    -   set(lookup_source_pk_given_sdss_id)
+    )
+    # These lookups only have one parameter per identifier, so use as few round trips as we can.
+    for chunk in chunked(existing_sdss_ids, get_max_parameters()):
+        lookup_source_pk_given_sdss_id.update(
+            Source
+            .select(
+                Source.sdss_id,
+                Source.pk,
+            )
+            .where(Source.sdss_id.in_(chunk))
+            .tuples()
+        )
+
     # Need to be able to look up source_pks given a target_id
-    lookup_source_pk_given_sdss_id = { sdss_id: pk for pk, sdss_id in q }
     lookup_source_pk_given_sdss4_apogee_id = {}
     for sdss4_apogee_id, attrs in source_data.items():
         source_pk = lookup_source_pk_given_sdss_id[attrs["sdss_id"]]
@@ -465,29 +487,32 @@ def migrate_sdss4_dr17_apogee_spectra_from_sdss5_catalogdb(batch_size: Optional[
         .dicts()
     )
     
-    apogee_visit_spectra = []
-    for row in tqdm(q.iterator(), total=limit or 1, desc="Retrieving spectra"):
-        basename = row.pop("file")
-        row["plate"] = row["plate"].lstrip()        
-        if row["telescope"] == "apo1m":
-            row["reduction"] = row["obj"]
-        
-        source_pk = lookup_source_pk_given_sdss4_apogee_id[row['obj']]        
-        apogee_visit_spectra.append({
-            "source_pk": source_pk,
-            "release": "dr17",
-            "apred": "dr17",
-            "prefix": basename.lstrip()[:2],
-            **row
-        })
+    # Stream the visits from the catalog database straight in to the upsert, rather than holding
+    # every visit in memory before we start upserting.
+    def get_apogee_visit_spectra():
+        for row in q.iterator():
+            basename = row.pop("file")
+            row["plate"] = row["plate"].lstrip()        
+            if row["telescope"] == "apo1m":
+                row["reduction"] = row["obj"]
+            
+            source_pk = lookup_source_pk_given_sdss4_apogee_id[row['obj']]        
+            yield {
+                "source_pk": source_pk,
+                "release": "dr17",
+                "apred": "dr17",
+                "prefix": basename.lstrip()[:2],
+                **row
+            }
 
     # Upsert the spectra
     pks = upsert_many(
         ApogeeVisitSpectrum,
         ApogeeVisitSpectrum.pk,
-        apogee_visit_spectra,
+        get_apogee_visit_spectra(),
         batch_size,
-        desc="Upserting spectra"
+        desc="Upserting spectra",
+        total=limit
     )
 
     # Assign spectrum_pk values to any spectra missing it.
@@ -500,7 +525,7 @@ def migrate_sdss4_dr17_apogee_spectra_from_sdss5_catalogdb(batch_size: Optional[
                     ApogeeVisitSpectrum
                     .update(
                         spectrum_pk=Case(None, (
-                            (ApogeeVisitSpectrum.pk == pk, spectrum_pk) for spectrum_pk, pk in enumerate_new_spectrum_pks(batch)
+                            (ApogeeVisitSpectrum.pk == pk, spectrum_pk) for spectrum_pk, pk in enumerate_new_spectrum_pks(batch, model=ApogeeVisitSpectrum)
                         ))
                     )
                     .where(ApogeeVisitSpectrum.pk.in_(batch))
@@ -525,7 +550,7 @@ def migrate_sdss4_dr17_apogee_spectra_from_sdss5_catalogdb(batch_size: Optional[
                 ApogeeVisitSpectrum
                 .update(
                     spectrum_pk=Case(None, [
-                        (ApogeeVisitSpectrum.pk == pk, spectrum_pk) for spectrum_pk, pk in enumerate_new_spectrum_pks(batch)
+                        (ApogeeVisitSpectrum.pk == pk, spectrum_pk) for spectrum_pk, pk in enumerate_new_spectrum_pks(batch, model=ApogeeVisitSpectrum)
                     ])
                 )
                 .where(ApogeeVisitSpectrum.pk.in_(batch))
@@ -556,11 +581,10 @@ def migrate_sdss4_dr17_apogee_spectra_from_sdss5_catalogdb(batch_size: Optional[
     )
 
     # Need to get source_pks based on existing 
-    apogee_coadded_spectra = []
-    for star in tqdm(q.iterator(), total=limit or q.count()):
-        source_pk = lookup_source_pk_given_sdss4_apogee_id[star.obj]             
-        apogee_coadded_spectra.append(
-            dict(
+    def get_apogee_coadded_spectra():
+        for star in q.iterator():
+            source_pk = lookup_source_pk_given_sdss4_apogee_id[star.obj]             
+            yield dict(
                 source_pk=source_pk,
                 release="dr17",
                 filetype="apStar",
@@ -571,15 +595,16 @@ def migrate_sdss4_dr17_apogee_spectra_from_sdss5_catalogdb(batch_size: Optional[
                 field=star.field,
                 prefix="ap" if star.telescope.startswith("apo") else "as",
             )
-        )
 
-    # Upsert the spectra
+    # Upsert the spectra as they are retrieved.
     pks = upsert_many(
         ApogeeCoaddedSpectrumInApStar,
         ApogeeCoaddedSpectrumInApStar.pk,
-        apogee_coadded_spectra,
+        get_apogee_coadded_spectra(),
         batch_size,
-        desc="Upserting spectra"
+        desc="Upserting spectra",
+        # The approximate table size is enough for the progress bar, and avoids running the DISTINCT twice.
+        total=limit or get_approximate_rows(Star)
     )
 
     # Assign spectrum_pk values to any spectra missing it.
@@ -592,7 +617,7 @@ def migrate_sdss4_dr17_apogee_spectra_from_sdss5_catalogdb(batch_size: Optional[
                     ApogeeCoaddedSpectrumInApStar
                     .update(
                         spectrum_pk=Case(None, (
-                            (ApogeeCoaddedSpectrumInApStar.pk == pk, spectrum_pk) for spectrum_pk, pk in enumerate_new_spectrum_pks(batch)
+                            (ApogeeCoaddedSpectrumInApStar.pk == pk, spectrum_pk) for spectrum_pk, pk in enumerate_new_spectrum_pks(batch, model=ApogeeCoaddedSpectrumInApStar)
                         ))
                     )
                     .where(ApogeeCoaddedSpectrumInApStar.pk.in_(batch))
@@ -733,30 +758,24 @@ def migrate_sdss4_dr17_metadata_from_headers():
     )
     drp_spectrum_data = {}
     for obj, spectrum_pk, telescope, plate, mjd, fiber in tqdm(q.iterator(), desc="Getting DRP spectrum data"):
-        drp_spectrum_data.setdefault(obj, {})
-        key = "_".join(map(str, (telescope, plate, mjd, fiber)))
-        drp_spectrum_data[obj][key] = spectrum_pk
+        drp_spectrum_data.setdefault(obj, {})[(telescope, plate, mjd, fiber)] = spectrum_pk
 
     log.info(f"Matching to DRP spectra")
+    get_visit_key = itemgetter("telescope", "plate", "mjd", "fiber")
 
-    for spectrum_pk, visit in enumerate_new_spectrum_pks(apogee_visit_spectra_in_apstar):
-        key = "_".join(map(str, [visit[k] for k in ("telescope", "plate", "mjd", "fiber")]))
+    for spectrum_pk, visit in enumerate_new_spectrum_pks(apogee_visit_spectra_in_apstar, model=ApogeeVisitSpectrumInApStar):
+        key = get_visit_key(visit)
         visit.update(
             spectrum_pk=spectrum_pk,
             drp_spectrum_pk=drp_spectrum_data[visit["obj"]][key]
         )
 
-    with database.atomic():
-        with tqdm(desc="Upserting visit spectra", total=len(apogee_visit_spectra_in_apstar)) as pb:
-            for chunk in chunked(apogee_visit_spectra_in_apstar, batch_size):
-                (
-                    ApogeeVisitSpectrumInApStar
-                    .insert_many(chunk)
-                    .on_conflict_ignore()
-                    .execute()
-                )
-                pb.update(min(batch_size, len(chunk)))
-                pb.refresh()
+    insert_many_ignoring_conflicts(
+        ApogeeVisitSpectrumInApStar,
+        apogee_visit_spectra_in_apstar,
+        batch_size,
+        desc="Upserting visit spectra"
+    )
     return None
 
 
@@ -936,19 +955,8 @@ def migrate_apvisit_from_sdss5_apogee_drpdb(
     log.info(f"Migrating SDSS5 apVisit spectra from SDSS5 catalog database")
 
 
-    ssq = (
-        RvVisit
-        .select(
-            RvVisit.visit_pk,
-            fn.MAX(RvVisit.starver).alias("max")
-        )
-        .where(
-            (RvVisit.apred_vers == apred)
-        &   (RvVisit.catalogid > 0) # Some RM_COSMOS fields with catalogid=0 (e.g., apogee_drp.visit = 7494220)
-        )  
-        .group_by(RvVisit.visit_pk)
-        .order_by(RvVisit.visit_pk.desc())
-    )
+    # Take the RvVisit with the highest `starver` for each visit. Using DISTINCT ON does this in one
+    # sorted scan, instead of aggregating the maximum `starver` and joining that back to RvVisit.
     sq = (
         RvVisit
         .select(
@@ -971,13 +979,12 @@ def migrate_apvisit_from_sdss5_apogee_drpdb(
             RvVisit.xcorr_vrad,
             RvVisit.n_components,
         )
-        .join(
-            ssq, 
-            on=(
-                (RvVisit.visit_pk == ssq.c.visit_pk)
-            &   (RvVisit.starver == ssq.c.max)
-            )
+        .where(
+            (RvVisit.apred_vers == apred)
+        &   (RvVisit.catalogid > 0) # Some RM_COSMOS fields with catalogid=0 (e.g., apogee_drp.visit = 7494220)
         )
+        .distinct(RvVisit.visit_pk)
+        .order_by(RvVisit.visit_pk.desc(), RvVisit.starver.desc())
     )
     if rvvisit_where is not None:
         sq = (
@@ -1090,13 +1097,17 @@ def migrate_apvisit_from_sdss5_apogee_drpdb(
     )
     
 
+    # Split each row in to source and spectrum information without mutating (and resizing) the row.
+    get_source_values = itemgetter(*source_only_keys)
+    source_only_key_set = frozenset(source_only_keys)
+
     source_data, spectrum_data, matched_sdss_ids = (OrderedDict(), [], {})
     for row in tqdm(q.iterator(), total=limit or 1, desc="Retrieving spectra"):
         basename = row.pop("file")
 
         catalogid = row["catalogid"]        
         
-        this_source_data = dict(zip(source_only_keys, [row.pop(k) for k in source_only_keys]))
+        this_source_data = dict(zip(source_only_keys, get_source_values(row)))
 
         if catalogid in source_data:
             # make sure the only difference is SDSS_ID
@@ -1112,7 +1123,7 @@ def migrate_apvisit_from_sdss5_apogee_drpdb(
             "release": "sdss5",
             "apred": apred,
             "prefix": basename.lstrip()[:2],
-            **row
+            **{ k: v for k, v in row.items() if k not in source_only_key_set }
         })
 
     q_without_rvs = (
@@ -1183,7 +1194,7 @@ def migrate_apvisit_from_sdss5_apogee_drpdb(
         assert row["catalogid"] is not None
         catalogid = row["catalogid"]        
         
-        this_source_data = dict(zip(source_only_keys, [row.pop(k) for k in source_only_keys]))
+        this_source_data = dict(zip(source_only_keys, get_source_values(row)))
 
         if catalogid in source_data:
             # make sure the only difference is SDSS_ID
@@ -1202,46 +1213,63 @@ def migrate_apvisit_from_sdss5_apogee_drpdb(
             "release": "sdss5",
             "apred": apred,
             "prefix": basename.lstrip()[:2],
-            **row
+            **{ k: v for k, v in row.items() if k not in source_only_key_set }
         })
 
 
-    # Upsert the sources
-    with database.atomic():
-        with tqdm(desc="Upserting sources", total=len(source_data)) as pb:
-            for chunk in chunked(source_data.values(), batch_size):
-                (
-                    Source
-                    .insert_many(chunk)
-                    .on_conflict_ignore()
-                    .execute()
-                )
-                pb.update(min(batch_size, len(chunk)))
-                pb.refresh()
-
-    log.info(f"Getting data for sources")
-    q = (
-        Source
-        .select(
-            Source.pk,
-            Source.sdss_id,
-            Source.catalogid,
-            Source.catalogid21,
-            Source.catalogid25,
-            Source.catalogid31
-        )
-        .tuples()
-        .iterator()
+    source_fields = (
+        Source.pk,
+        Source.sdss_id,
+        Source.catalogid,
+        Source.catalogid21,
+        Source.catalogid25,
+        Source.catalogid31
     )
-
     source_pk_by_sdss_id = {}
     source_pk_by_catalogid = {}
-    for pk, sdss_id, *catalogids in q:
-        if sdss_id is not None:
-            source_pk_by_sdss_id[sdss_id] = pk
-        for catalogid in catalogids:
-            if catalogid is not None:
-                source_pk_by_catalogid[catalogid] = pk
+    def index_sources(rows):
+        for pk, sdss_id, *catalogids in rows:
+            if sdss_id is not None:
+                source_pk_by_sdss_id[sdss_id] = pk
+            for catalogid in catalogids:
+                if catalogid is not None:
+                    source_pk_by_catalogid[catalogid] = pk
+
+    # Upsert the sources, and keep the identifiers of the sources that were inserted.
+    index_sources(
+        copy_upsert_many(
+            Source,
+            source_fields,
+            source_data.values(),
+            batch_size,
+            desc="Upserting sources"
+        )
+    )
+
+    # Sources that already existed are not returned by the upsert, so only look those up.
+    log.info(f"Getting data for existing sources")
+    existing_sdss_ids = set(matched_sdss_ids.values()) - set(source_pk_by_sdss_id) - {None}
+    existing_catalogids = set(source_data) - set(source_pk_by_catalogid) - {None}
+    # These lookups only have one parameter per identifier, so use as few round trips as we can.
+    for chunk in chunked(existing_sdss_ids, get_max_parameters()):
+        index_sources(
+            Source
+            .select(*source_fields)
+            .where(Source.sdss_id.in_(chunk))
+            .tuples()
+        )
+    for chunk in chunked(existing_catalogids, get_max_parameters() // 4):
+        index_sources(
+            Source
+            .select(*source_fields)
+            .where(
+                Source.catalogid.in_(chunk)
+            |   Source.catalogid21.in_(chunk)
+            |   Source.catalogid25.in_(chunk)
+            |   Source.catalogid31.in_(chunk)
+            )
+            .tuples()
+        )
         
     for each in spectrum_data:
         catalogid = each["catalogid"]
@@ -1273,7 +1301,7 @@ def migrate_apvisit_from_sdss5_apogee_drpdb(
                     ApogeeVisitSpectrum
                     .update(
                         spectrum_pk=Case(None, (
-                            (ApogeeVisitSpectrum.pk == pk, spectrum_pk) for spectrum_pk, pk in enumerate_new_spectrum_pks(batch)
+                            (ApogeeVisitSpectrum.pk == pk, spectrum_pk) for spectrum_pk, pk in enumerate_new_spectrum_pks(batch, model=ApogeeVisitSpectrum)
                         ))
                     )
                     .where(ApogeeVisitSpectrum.pk.in_(batch))
@@ -1298,7 +1326,7 @@ def migrate_apvisit_from_sdss5_apogee_drpdb(
                 ApogeeVisitSpectrum
                 .update(
                     spectrum_pk=Case(None, [
-                        (ApogeeVisitSpectrum.pk == pk, spectrum_pk) for spectrum_pk, pk in enumerate_new_spectrum_pks(batch)
+                        (ApogeeVisitSpectrum.pk == pk, spectrum_pk) for spectrum_pk, pk in enumerate_new_spectrum_pks(batch, model=ApogeeVisitSpectrum)
                     ])
                 )
                 .where(ApogeeVisitSpectrum.pk.in_(batch))
@@ -1324,7 +1352,43 @@ def migrate_apvisit_from_sdss5_apogee_drpdb(
     return N
         
 
+def _read_header_cards(path, keys, size=12000):
+    """
+    Read the values of header cards directly from the first `size` bytes of a FITS file.
+
+    :param path:
+        The path of the FITS file.
+
+    :param keys:
+        A tuple of header keywords (as bytes) to read. Only the first occurrence of each key with a
+        non-blank value is used.
+
+    :param size: [optional]
+        The number of bytes to read. The default is 12000 bytes (150 cards of 80 characters each).
+    """
+    with open(expand_path(path), "rb") as fp:
+        blob = fp.read(size)
+
+    cards = {}
+    for offset in range(0, len(blob), 80):
+        key = blob[offset:offset + 8].rstrip()
+        if key in keys and key.decode() not in cards:
+            _, _, value = blob[offset + 8:offset + 80].partition(b"=")
+            value = value.split()
+            # Cards with a blank value are treated as missing.
+            if value:
+                cards[key.decode()] = value[0].strip(b" '").decode()
+    return cards
+
+
 def _migrate_apvisit_metadata(apVisits, raise_exceptions=False):
+    """
+    Read metadata from the headers of apVisit files.
+
+    :param apVisits:
+        A list of `(spectrum_pk, path)` tuples. We send these to workers instead of the
+        `ApogeeVisitSpectrum` instances, because they are much cheaper to pickle.
+    """
     def float_or_nan(x):
         try:
             return float(x)
@@ -1336,37 +1400,29 @@ def _migrate_apvisit_metadata(apVisits, raise_exceptions=False):
         "NCOMBINE": int, 
         "EXPTIME": float_or_nan,
     }
-    K = len(keys_dtypes)
-    keys_str = "|".join([f"({k})" for k in keys_dtypes.keys()])
+    keys = tuple(k.encode() for k in keys_dtypes.keys())
 
-    # 80 chars per line, 150 lines -> 12000
-    command_template = " | ".join([
-        'hexdump -n 12000 -e \'80/1 "%_p" "\\n"\' {path}',
-        f'egrep "{keys_str}"',
-        f"head -n {K}"
-    ])
-    commands = ""
-    for apVisit in apVisits:
-        path = expand_path(apVisit.path)
-        commands += f"{command_template.format(path=path)}\n"
-    
-    outputs = subprocess.check_output(commands, shell=True, text=True)
-    outputs = outputs.strip().split("\n")
+    all_metadata = {}
+    for spectrum_pk, path in apVisits:
+        try:
+            cards = _read_header_cards(path, keys)
+            metadata = {}
+            for key, value in cards.items():
+                value = keys_dtypes[key](value)
+                if key == "NAXIS1":
+                    # @Nidever: "if there’s 2048 then it hasn’t been dithered, if it’s 4096 then it’s dithered."
+                    metadata["dithered"] = (value == 4096)
+                elif key == "NCOMBINE":
+                    metadata["n_frames"] = value
+                else:
+                    metadata[key.lower()] = value
+        except (OSError, ValueError, IndexError):
+            if raise_exceptions:
+                raise
+            log.exception(f"Could not read header of spectrum_pk={spectrum_pk}: {expand_path(path)}")
+            continue
 
-    index, all_metadata = (0, {})
-    for line in outputs:
-        all_metadata.setdefault(apVisits[index].spectrum_pk, {})
-        key, value = line.split("=")
-        key, value = (key.strip(), value.split()[0].strip(" '"))
-        value = keys_dtypes[key](value)
-        if key == "NAXIS1":
-            # @Nidever: "if there’s 2048 then it hasn’t been dithered, if it’s 4096 then it’s dithered."
-            all_metadata[apVisits[index].spectrum_pk]["dithered"] = (value == 4096)
-            index += 1            
-        elif key == "NCOMBINE":
-            all_metadata[apVisits[index].spectrum_pk]["n_frames"] = value
-        else:
-            all_metadata[apVisits[index].spectrum_pk][key.lower()] = value
+        all_metadata.setdefault(spectrum_pk, {}).update(metadata)
             
         
     '''
@@ -1456,43 +1512,44 @@ def migrate_apvisit_metadata_from_image_headers(
         .iterator()
     )
 
-    executor = concurrent.futures.ProcessPoolExecutor(max_workers)
-
-    apVisits, futures, total = ({}, [], 0)
-    with tqdm(total=limit or 0, desc="Retrieving metadata", unit="spectra") as pb:
-        for chunk in chunked(q, batch_size):
-            futures.append(executor.submit(_migrate_apvisit_metadata, chunk))
-            for total, apVisit in enumerate(chunk, start=1 + total):
-                apVisits[apVisit.spectrum_pk] = apVisit
-                pb.update()
-
-
-    with tqdm(total=total, desc="Collecting results", unit="spectra") as pb:
-        for future in concurrent.futures.as_completed(futures):
-            for spectrum_pk, meta in future.result().items():
-                for key, value in meta.items():
-                    setattr(apVisits[spectrum_pk], key, value)
-                
-                pb.update()
-
-    with tqdm(total=total, desc="Updating", unit="spectra") as pb:     
-        for chunk in chunked(apVisits.values(), batch_size):
-            pb.update(
-                ApogeeVisitSpectrum  
-                .bulk_update(
-                    chunk,
-                    fields=[
-                        ApogeeVisitSpectrum.dithered,
-                        ApogeeVisitSpectrum.snr,
-                        ApogeeVisitSpectrum.n_frames,
-                        ApogeeVisitSpectrum.exptime
-                    ]
+    # Keep a bounded number of chunks in flight, and update the database as the oldest chunk
+    # finishes, instead of holding every spectrum (and future) in memory until all are done.
+    max_pending = 2 * (max_workers or 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        pending = deque()
+        with tqdm(total=limit or 0, desc="Updating", unit="spectra") as pb:
+            for chunk in chunked(q, batch_size):
+                future = executor.submit(
+                    _migrate_apvisit_metadata, 
+                    [(apVisit.spectrum_pk, apVisit.path) for apVisit in chunk]
                 )
-            )
+                pending.append((chunk, future))
+                if len(pending) >= max_pending:
+                    pb.update(_update_apvisit_metadata(*pending.popleft()))
+            while pending:
+                pb.update(_update_apvisit_metadata(*pending.popleft()))
 
     return pb.n
 
 
+def _update_apvisit_metadata(apVisits, future):
+    apVisit_by_spectrum_pk = { apVisit.spectrum_pk: apVisit for apVisit in apVisits }
+    for spectrum_pk, meta in future.result().items():
+        for key, value in meta.items():
+            setattr(apVisit_by_spectrum_pk[spectrum_pk], key, value)
+
+    fields = (
+        ApogeeVisitSpectrum.dithered,
+        ApogeeVisitSpectrum.snr,
+        ApogeeVisitSpectrum.n_frames,
+        ApogeeVisitSpectrum.exptime
+    )
+    return update_many(
+        ApogeeVisitSpectrum,
+        fields,
+        [(apVisit.pk, *(getattr(apVisit, field.name) for field in fields)) for apVisit in apVisits]
+    )
+
 
 def migrate_apstar_from_sdss5_database(apred, where=None, limit=None, batch_size=100, max_workers=8):
 
@@ -1623,7 +1680,7 @@ def migrate_apstar_from_sdss5_database(apred, where=None, limit=None, batch_size
                     ApogeeCoaddedSpectrumInApStar
                     .update(
                         spectrum_pk=Case(None, (
-                            (ApogeeCoaddedSpectrumInApStar.pk == pk, spectrum_pk) for spectrum_pk, pk in enumerate_new_spectrum_pks(batch)
+                            (ApogeeCoaddedSpectrumInApStar.pk == pk, spectrum_pk) for spectrum_pk, pk in enumerate_new_spectrum_pks(batch, model=ApogeeCoaddedSpectrumInApStar)
                         ))
                     )
                     .where(ApogeeCoaddedSpectrumInApStar.pk.in_(batch))
@@ -1765,16 +1822,15 @@ def migrate_apstar_from_sdss5_database(apred, where=None, limit=None, batch_size
     )
     drp_spectrum_data = {}
     for obj, spectrum_pk, telescope, plate, mjd, fiber in tqdm(q.iterator(), desc="Getting DRP spectrum data"):
-        drp_spectrum_data.setdefault(obj, {})
-        key = "_".join(map(str, (telescope, plate, mjd, fiber)))
-        drp_spectrum_data[obj][key] = spectrum_pk
+        drp_spectrum_data.setdefault(obj, {})[(telescope, plate, mjd, fiber)] = spectrum_pk
 
     log.info(f"Matching to DRP spectra")
+    get_visit_key = itemgetter("telescope", "plate", "mjd", "fiber")
 
     only_ingest_visits = []
     failed_to_match_to_drp_spectrum_pk = []
-    for spectrum_pk, visit in enumerate_new_spectrum_pks(visit_spectrum_data):
-        key = "_".join(map(str, [visit[k] for k in ("telescope", "plate", "mjd", "fiber")]))
+    for spectrum_pk, visit in enumerate_new_spectrum_pks(visit_spectrum_data, model=ApogeeVisitSpectrumInApStar):
+        key = get_visit_key(visit)
         try:
             drp_spectrum_pk = drp_spectrum_data[visit["obj"]][key]
         except:
@@ -1790,16 +1846,11 @@ def migrate_apstar_from_sdss5_database(apred, where=None, limit=None, batch_size
         log.warning(f"There were {len(failed_to_match_to_drp_spectrum_pk)} spectra that we could not match to DRP spectra")
         log.warning(f"Example: {failed_to_match_to_drp_spectrum_pk[0]}")
 
-    with database.atomic():
-        with tqdm(desc="Upserting visit spectra", total=len(only_ingest_visits)) as pb:
-            for chunk in chunked(only_ingest_visits, batch_size):
-                (
-                    ApogeeVisitSpectrumInApStar
-                    .insert_many(chunk)
-                    .on_conflict_ignore()
-                    .execute()
-                )
-                pb.update(min(batch_size, len(chunk)))
-                pb.refresh()
+    insert_many_ignoring_conflicts(
+        ApogeeVisitSpectrumInApStar,
+        only_ingest_visits,
+        batch_size,
+        desc="Upserting visit spectra"
+    )
 
     return N
\ No newline at end of file
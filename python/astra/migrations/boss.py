@@ -123,7 +123,7 @@ def migrate_spectra_from_spall_file(
     with tqdm(total=len(spectrum_data), desc="Linking to Catalog") as pb:
         for chunk in chunked(spectrum_data, batch_size):
 
-            chunk_catalogids = []
+            # The keys of this dictionary are the catalog identifiers to query for this chunk.
             gaia_dr2_source_id_given_catalogid = {}
             for row in chunk:
                 for key in ("catalogid", "catalogid_v0", "catalogid_v0p5"):
@@ -131,7 +131,6 @@ def migrate_spectra_from_spall_file(
                         if np.all(row[key].mask):
                             continue
                     except:
-                        chunk_catalogids.append(row[key])
                         gaia_dr2_source_id_given_catalogid[row[key]] = row["gaia_dr2_source_id"]
 
             q = (
@@ -152,26 +151,25 @@ def migrate_spectra_from_spall_file(
                 .join(SDSS_ID_Flat, JOIN.LEFT_OUTER, on=(Catalog.catalogid == SDSS_ID_Flat.catalogid))
                 .join(SDSS_ID_Stacked, JOIN.LEFT_OUTER, on=(SDSS_ID_Stacked.sdss_id == SDSS_ID_Flat.sdss_id))
                 .join(CatalogToGaia_DR3, JOIN.LEFT_OUTER, on=(SDSS_ID_Stacked.catalogid31 == CatalogToGaia_DR3.catalog))
-                .where(Catalog.catalogid.in_(chunk_catalogids))
+                .where(Catalog.catalogid.in_(list(gaia_dr2_source_id_given_catalogid)))
                 .dicts()
             )
                     
-            reference_key = "catalogid"
             for row in q:
-                if row[reference_key] in source_data:
+                catalogid = row["catalogid"]
+                existing = source_data.get(catalogid, None)
+                if existing is not None:
+                    # Fill in anything missing from the first row we saw for this catalogid.
                     for key, value in row.items():
-                        if source_data[row[reference_key]][key] is None and value is not None:
-                            if key == "sdss_id":
-                                source_data[row[reference_key]][key] = min(source_data[row[reference_key]][key], value)
-                            else:
-                                source_data[row[reference_key]][key] = value
+                        if value is not None and existing[key] is None:
+                            existing[key] = value
                     continue
 
-                source_data[row[reference_key]] = row
-                gaia_dr2_source_id = gaia_dr2_source_id_given_catalogid[row[reference_key]]
+                source_data[catalogid] = row
+                gaia_dr2_source_id = gaia_dr2_source_id_given_catalogid[catalogid]
                 if gaia_dr2_source_id < 0:
                     gaia_dr2_source_id = None
-                source_data[row[reference_key]]["gaia_dr2_source_id"] = gaia_dr2_source_id
+                row["gaia_dr2_source_id"] = gaia_dr2_source_id
             
             pb.update(batch_size)
     
@@ -248,7 +246,7 @@ def migrate_spectra_from_spall_file(
                     BossVisitSpectrum
                     .update(
                         spectrum_pk=Case(None, (
-                            (BossVisitSpectrum.pk == pk, spectrum_pk) for spectrum_pk, pk in enumerate_new_spectrum_pks(batch)
+                            (BossVisitSpectrum.pk == pk, spectrum_pk) for spectrum_pk, pk in enumerate_new_spectrum_pks(batch, model=BossVisitSpectrum)
                         ))
                     )
                     .where(BossVisitSpectrum.pk.in_(batch))
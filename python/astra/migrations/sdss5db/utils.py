@@ -12,7 +12,8 @@ def get_profile():
 def get_approximate_rows(model):
     return int(
         model._meta.database.execute_sql(
-            f"SELECT reltuples FROM pg_class WHERE relname = '{model.__name__.lower()}';"
+            "SELECT reltuples FROM pg_class WHERE relname = %s;",
+            (model._meta.table_name, )
         )
         .fetchone()[0]
     )
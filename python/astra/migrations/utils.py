@@ -1,45 +1,173 @@
-from peewee import chunked
+import csv
+from io import StringIO
+from itertools import chain
+from peewee import chunked, fn, NodeList, PostgresqlDatabase, Select, SQL, Value, ValuesList
 from astra.utils import flatten
 from astra.models.base import database
-from astra.models.spectrum import Spectrum
+from astra.models.spectrum import Spectrum, get_spectrum_type_flag
 from tqdm import tqdm
 
-def generate_new_spectrum_pks(N, batch_size=100):
+def get_max_parameters():
+    """Return the maximum number of parameters allowed in one statement by the database."""
+    return 65535 if isinstance(database, PostgresqlDatabase) else 32766
+
+
+def get_max_batch_size(model, batch_size=None):
+    """
+    Return a batch size for inserting rows of `model` that stays under the database's limit on the
+    number of parameters in one statement.
+
+    :param model:
+        The model that rows will be inserted for.
+
+    :param batch_size: [optional]
+        The requested batch size. If `None`, the largest allowed batch size is returned.
+    """
+    max_batch_size = get_max_parameters() // max(1, len(model._meta.sorted_fields))
+    return min(batch_size or max_batch_size, max_batch_size)
+
+
+def mint_spectrum_pks(N, model=None):
+    """
+    Insert `N` placeholder rows into the `Spectrum` table with a single statement, and return their primary keys.
+
+    :param N:
+        The number of spectrum primary keys to create.
+
+    :param model: [optional]
+        The spectrum model that these primary keys will be assigned to. If given, this is recorded
+        in `Spectrum.spectrum_type_flags` so that `Spectrum.resolve` can go straight to that table.
+    """
+    if N < 1:
+        return ()
+
+    flags = get_spectrum_type_flag(model)
+    if isinstance(database, PostgresqlDatabase):
+        rows = Select(columns=(Value(flags), )).from_(fn.generate_series(1, N))
+    else:
+        # SQLite does not have `generate_series` by default, so use a recursive CTE to count to N.
+        series = Select(columns=(Value(1), )).cte("series", recursive=True, columns=("i", ))
+        series = series.union_all(Select(columns=(series.c.i + 1, )).from_(series).where(series.c.i < N))
+        rows = Select(columns=(Value(flags), )).from_(series).with_cte(series)
+
+    return tuple(
+        flatten(
+            Spectrum
+            .insert_from(rows, [Spectrum.spectrum_type_flags])
+            .returning(Spectrum.pk)
+            .tuples()
+            .execute()
+        )
+    )
+
+
+def generate_new_spectrum_pks(N, batch_size=100, model=None):
     with database.atomic():
-        # Need to chunk this to avoid SQLite limits.
         with tqdm(desc="Assigning spectrum identifiers", unit="spectra", total=N) as pb:
-            for chunk in chunked([{"spectrum_type_flags": 0}] * N, batch_size):                
-                yield from flatten(
-                    Spectrum
-                    .insert_many(chunk)
-                    .returning(Spectrum.pk)
-                    .tuples()
-                    .execute()
-                )
-                pb.update(min(batch_size, len(chunk)))
-                pb.refresh()
+            spectrum_pks = mint_spectrum_pks(N, model)
+            pb.update(len(spectrum_pks))
+            yield from spectrum_pks
+
+
+def enumerate_new_spectrum_pks(iter, batch_size=100, model=None):
+    with database.atomic():
+        for chunk in chunked(iter, batch_size):
+            yield from zip(mint_spectrum_pks(len(chunk), model), chunk)
 
 
-def enumerate_new_spectrum_pks(iter, batch_size=100):
-    N = len(iter)
+def update_many(model, fields, data, batch_size=None):
+    """
+    Update many rows with one `UPDATE ... FROM (VALUES ...)` statement per batch.
 
+    Unlike `Model.bulk_update`, this does not build a `CASE` expression for every field in every row.
+
+    :param model:
+        The model to update rows for.
+
+    :param fields:
+        A tuple of fields to update.
+
+    :param data:
+        An iterable of tuples, where the first item is the primary key of the row to update, and
+        the remaining items are the values of `fields`.
+
+    :param batch_size: [optional]
+        The number of rows to update per statement. If `None`, the largest batch size allowed by the
+        database is used.
+
+    :returns:
+        The number of rows updated.
+    """
+    is_postgresql = isinstance(database, PostgresqlDatabase)
+    # SQLite does not allow naming the columns of a VALUES list, but names them `column1`, ... `columnN`,
+    # so we use those names everywhere.
+    columns = [f"column{i}" for i in range(1, 2 + len(fields))]
+    batch_size = min(get_max_batch_size(model, batch_size), get_max_parameters() // len(columns))
+    ctx = database.get_sql_context()
+
+    # Convert the values the same way peewee would for an ordinary update.
+    db_values = [model._meta.primary_key.db_value] + [field.db_value for field in fields]
+
+    n_updated = 0
     with database.atomic():
-        for chunk, batch in zip(chunked(iter, batch_size), chunked([{"spectrum_type_flags": 0}] * len(iter), batch_size)):
-            spectrum_pks = flatten(
-                Spectrum
-                .insert_many(batch)
-                .returning(Spectrum.pk)
-                .tuples()
+        for chunk in chunked(data, batch_size):
+            chunk = [tuple(db_value(v) for db_value, v in zip(db_values, row)) for row in chunk]
+            values = ValuesList(chunk, columns=columns if is_postgresql else None, alias="update_values")
+            pk, *value_columns = (getattr(values.c, column) for column in columns)
+            if is_postgresql:
+                # Explicitly cast the values, otherwise a column of all nulls is typed as text by PostgreSQL.
+                # We don't cast on SQLite, where casting to a type with NUMERIC affinity (e.g., DATETIME)
+                # would mangle the values, and the column affinity already applies on update.
+                update = { 
+                    field: fn.CAST(NodeList((column, SQL("AS"), field.ddl_datatype(ctx))))
+                    for field, column in zip(fields, value_columns)
+                }
+            else:
+                update = dict(zip(fields, value_columns))
+            n_updated += (
+                model
+                .update(update)
+                .from_(values)
+                .where(model._meta.primary_key == pk)
                 .execute()
             )
-            for spectrum_pk, item in zip(spectrum_pks, chunk):
-                yield (spectrum_pk, item)
+    return n_updated
+
+
+def upsert_many(model, returning, data, batch_size, desc="Upserting", total=None):
+    """
+    Insert rows in chunks, ignoring any conflicts, and return the `returning` field of the inserted rows.
 
+    :param model:
+        The model to upsert rows for.
 
-def upsert_many(model, returning, data, batch_size, desc="Upserting"):
+    :param returning:
+        The field to return.
+
+    :param data:
+        An iterable of dictionaries to upsert.
+
+    :param batch_size:
+        The number of rows to upsert per statement. If `None`, the largest batch size allowed by the
+        database is used.
+
+    :param desc: [optional]
+        The description to use for the progress bar.
+
+    :param total: [optional]
+        The total number of rows, for the progress bar. If `None`, then `len(data)` is used if possible.
+    """
+    if total is None:
+        try:
+            total = len(data)
+        except TypeError:
+            # `data` is a generator; rows will be upserted as they are generated.
+            None
+
+    batch_size = get_max_batch_size(model, batch_size)
     returned = []
     with database.atomic():
-        with tqdm(desc=desc, total=len(data)) as pb:
+        with tqdm(desc=desc, total=total) as pb:
             for chunk in chunked(data, batch_size):
                 returned.extend(
                     flatten(
@@ -54,4 +182,169 @@ def upsert_many(model, returning, data, batch_size, desc="Upserting"):
                 pb.update(min(batch_size, len(chunk)))
                 pb.refresh()
 
-    return tuple(returned)
\ No newline at end of file
+    return tuple(returned)
+
+
+def copy_upsert_many(model, returning, data, batch_size, desc="Upserting", total=None):
+    """
+    Insert rows in to a table, ignoring any conflicts, and return the `returning` fields of the inserted rows.
+
+    On PostgreSQL the rows are streamed to a temporary table with `COPY` and then inserted with a single
+    statement. On other databases the rows are inserted in chunks of `batch_size`.
+
+    :param model:
+        The model to insert rows for.
+
+    :param returning:
+        A tuple of fields to return for every inserted row.
+
+    :param data:
+        An iterable of dictionaries, all with the same keys.
+
+    :param batch_size:
+        The batch size to use when the database does not support `COPY`. If `None`, the largest batch
+        size allowed by the database is used.
+
+    :param desc: [optional]
+        The description to use for the progress bar.
+
+    :param total: [optional]
+        The total number of rows, for the progress bar. If `None`, then `len(data)` is used if possible.
+    """
+    if total is None:
+        try:
+            total = len(data)
+        except TypeError:
+            # `data` is a generator; rows will be upserted as they are generated.
+            None
+
+    if not isinstance(database, PostgresqlDatabase):
+        batch_size = get_max_batch_size(model, batch_size)
+        returned = []
+        with database.atomic():
+            with tqdm(desc=desc, total=total) as pb:
+                for chunk in chunked(data, batch_size):
+                    returned.extend(
+                        model
+                        .insert_many(chunk)
+                        .on_conflict_ignore()
+                        .returning(*returning)
+                        .tuples()
+                        .execute()
+                    )
+                    pb.update(len(chunk))
+        return returned
+
+    data = iter(data)
+    try:
+        first = next(data)
+    except StopIteration:
+        return []
+
+    fields = _get_insert_fields(model, first)
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    with tqdm(desc=desc, total=total) as pb:
+        for row in chain((first, ), data):
+            writer.writerow([
+                r"\N" if value is None else value 
+                for value in _get_insert_values(model, fields, row)
+            ])
+            pb.update()
+    buffer.seek(0)
+
+    table = _get_table_name(model)
+    temporary_table = f'"tmp_{model._meta.table_name}"'
+    columns = ", ".join(f'"{field.column_name}"' for field in fields)
+    returning_columns = ", ".join(f'"{field.column_name}"' for field in returning)
+    with database.atomic():
+        cursor = database.cursor()
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE {temporary_table} AS "
+            f"SELECT {columns} FROM {table} WITH NO DATA"
+        )
+        cursor.copy_expert(
+            f"COPY {temporary_table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+            buffer
+        )
+        cursor.execute(
+            f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {temporary_table} "
+            f"ON CONFLICT DO NOTHING RETURNING {returning_columns}"
+        )
+        returned = cursor.fetchall()
+        # Drop the table now rather than on commit, because we may be inside an outer transaction
+        # and the next call would re-use the same name. If anything above fails, the (outer)
+        # transaction is rolled back to before the table was created.
+        cursor.execute(f"DROP TABLE {temporary_table}")
+        return returned
+
+
+def insert_many_ignoring_conflicts(model, data, batch_size, desc="Inserting"):
+    """
+    Insert rows in to a table, ignoring any conflicts.
+
+    On SQLite the rows are inserted with one prepared statement through the cursor's `executemany`,
+    which avoids building a new query for every chunk. On other databases (where `executemany` is
+    not faster than a multi-row `INSERT`) the rows are inserted in chunks with `insert_many`.
+
+    :param model:
+        The model to insert rows for.
+
+    :param data:
+        A list of dictionaries, all with the same keys.
+
+    :param batch_size:
+        The number of rows to insert per chunk.
+
+    :param desc: [optional]
+        The description to use for the progress bar.
+    """
+    if not data:
+        return None
+
+    if isinstance(database, PostgresqlDatabase):
+        sql = None
+    else:
+        fields = _get_insert_fields(model, data[0])
+        columns = ", ".join(f'"{field.column_name}"' for field in fields)
+        placeholders = ", ".join([database.param] * len(fields))
+        sql = f"INSERT INTO {_get_table_name(model)} ({columns}) VALUES ({placeholders}) ON CONFLICT DO NOTHING"
+
+    with database.atomic():
+        with tqdm(desc=desc, total=len(data)) as pb:
+            for chunk in chunked(data, batch_size):
+                if sql is None:
+                    model.insert_many(chunk).on_conflict_ignore().execute()
+                else:
+                    database.cursor().executemany(
+                        sql, 
+                        [_get_insert_values(model, fields, row) for row in chunk]
+                    )
+                pb.update(len(chunk))
+    return None
+
+
+def _get_table_name(model):
+    return ".".join(f'"{name}"' for name in (model._meta.schema, model._meta.table_name) if name)
+
+
+def _get_insert_fields(model, row):
+    # Include any fields with (Python-side) defaults, like `insert_many` would.
+    fields = [model._meta.combined[name] for name in row]
+    # Compare names, because `Field.__eq__` builds an expression.
+    names = { field.name for field in fields }
+    fields.extend(field for field in model._meta.defaults if field.name not in names)
+    return fields
+
+
+def _get_insert_values(model, fields, row):
+    values = []
+    for field in fields:
+        try:
+            value = row[field.name]
+        except KeyError:
+            value = model._meta.defaults[field]
+            if callable(value):
+                value = value()
+        values.append(field.db_value(value))
+    return values
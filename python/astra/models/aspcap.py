@@ -3,7 +3,7 @@ from peewee import (
     FloatField,
     TextField,
     ForeignKeyField,
-    IntegerField,
+    SmallIntegerField,
     BitField,
     DateTimeField,
     BooleanField,
@@ -294,9 +294,9 @@ class ASPCAP(BaseModel, PipelineOutputMixin):
 
     #> FERRE Settings
     short_grid_name = TextField(default="", help_text="Short name describing the FERRE grid used")
-    continuum_order = IntegerField(default=-1, help_text="Continuum order used in FERRE")
+    continuum_order = SmallIntegerField(default=-1, help_text="Continuum order used in FERRE")
     continuum_reject = FloatField(null=True, help_text="Tolerance for FERRE to reject continuum points")
-    interpolation_order = IntegerField(default=-1, help_text="Interpolation order used by FERRE")
+    interpolation_order = SmallIntegerField(default=-1, help_text="Interpolation order used by FERRE")
     initial_flags = BitField(default=0, help_text=Glossary.initial_flags)
     flag_initial_guess_from_apogeenet = initial_flags.flag(2**0, help_text="Initial guess from APOGEENet")
     flag_initial_guess_from_doppler = initial_flags.flag(2**1, help_text="Initial guess from Doppler (SDSS-V)")
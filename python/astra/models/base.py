@@ -3,6 +3,7 @@ __all__ = ["BaseModel", "database"]
 
 import os
 import re
+import sqlite3
 import numpy as np
 
 from peewee import (
@@ -20,6 +21,7 @@ from peewee import (
     JOIN
 )
 from inspect import getsource
+from functools import lru_cache
 from playhouse.sqlite_ext import SqliteExtDatabase
 from sdsstools.configuration import get_config
 
@@ -49,8 +51,12 @@ def get_database_and_schema(config):
             'cache_size': -1 * 64000,  # 64MB
             'foreign_keys': 1,
             'ignore_check_constraints': 0,
-            'synchronous': 0
-        }
+            'synchronous': 0,
+            'temp_store': 'memory',  # keep temporary tables and indices (e.g., for sorting) in memory
+            'mmap_size': 2**30,  # 1GB
+        },
+        # SQLite >= 3.35 supports RETURNING, which lets `bulk_create` fill in primary keys.
+        returning_clause=sqlite3.sqlite_version_info >= (3, 35, 0),
     )
 
     config_placement_message = (
@@ -146,6 +152,13 @@ if os.environ.get("FOO", False):
     schema = "astra_043"
     print("SETTING SCHEMA")
 
+@lru_cache(maxsize=None)
+def _get_source(cls):
+    # Source introspection reads (and tokenizes) the module file, and the category headers 
+    # and comments are requested for every HDU we create, so only do it once per class.
+    return getsource(cls)
+
+
 class BaseModel(Model):
     
     class Meta:
@@ -171,7 +184,7 @@ class BaseModel(Model):
 
 
         pattern = '\s{4}#>\s*(.+)\n\s{4}([\w|\d|_]+)\s*='
-        source_code = getsource(cls)
+        source_code = _get_source(cls)
         category_headers = []
         for header, field_name in re.findall(pattern, source_code):
             if hasattr(cls, field_name) and isinstance(getattr(cls, field_name), Field):
@@ -188,7 +201,7 @@ class BaseModel(Model):
     @property
     def category_comments(cls):
         pattern = '\s{4}([\w|\d|_]+)\s*=.+\n\s{4}#<\s*(.+)'
-        source_code = getsource(cls)
+        source_code = _get_source(cls)
         comments = []
         for field_name, comment in re.findall(pattern, source_code):
             if hasattr(cls, field_name) and isinstance(getattr(cls, field_name), Field):
@@ -4,6 +4,7 @@ from peewee import (
     TextField,
     ForeignKeyField,
     IntegerField,
+    SmallIntegerField,
     BitField,
     DateTimeField,
     BooleanField,
@@ -11,7 +12,6 @@ from peewee import (
 
 import datetime
 import numpy as np
-from functools import cached_property
 
 from astra import __version__
 from astra.models.base import BaseModel
@@ -22,100 +22,106 @@ from astra.models.pipeline import PipelineOutputMixin
 from astra.glossary import Glossary
 
 
-from astra.pipelines.ferre.utils import (get_apogee_pixel_mask, parse_ferre_spectrum_name)
+from astra.pipelines.ferre.utils import (get_apogee_pixel_mask, get_ferre_spectrum_name, parse_ferre_spectrum_name, read_ferre_pixel_file)
 
 APOGEE_FERRE_MASK = get_apogee_pixel_mask()
 
+class _cache_readonly:
+
+    """
+    Like `functools.cached_property`, but the values are kept together in a `_ferre_cache` 
+    dictionary on the instance, so that they can be dropped all at once with 
+    `FerreOutputMixin.clear_ferre_cache`.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        cache = instance.__dict__.setdefault("_ferre_cache", {})
+        try:
+            return cache[self.name]
+        except KeyError:
+            value = cache[self.name] = self.func(instance)
+            return value
+
 
 class FerreOutputMixin(PipelineOutputMixin):
         
-    @cached_property
+    @_cache_readonly
     def ferre_flux(self):
         return self._get_input_pixel_array("flux.input")
         
-    @cached_property
+    @_cache_readonly
     def ferre_e_flux(self):
         return self._get_input_pixel_array("e_flux.input")
     
 
-    @cached_property
+    @_cache_readonly
     def model_flux(self):
         return self._get_output_pixel_array("model_flux.output")
         
-    @cached_property
+    @_cache_readonly
     def rectified_model_flux(self):
         return self._get_output_pixel_array("rectified_model_flux.output")
         
-    @cached_property
+    @_cache_readonly
     def rectified_flux(self):
         return self._get_output_pixel_array("rectified_flux.output")
 
-    @cached_property
+    @_cache_readonly
     def e_rectified_flux(self):
-        continuum = self.ferre_flux / self.rectified_flux
-        return self.ferre_e_flux / continuum
+        # This is ferre_e_flux / (ferre_flux / rectified_flux), with one temporary array. The pixel 
+        # arrays may be stored in a narrower type (see `FERRE_PIXEL_DTYPE`), so do this in at least
+        # 32-bit precision to avoid underflow.
+        e_rectified_flux = np.multiply(
+            self.ferre_e_flux, 
+            self.rectified_flux, 
+            dtype=np.promote_types(self.ferre_e_flux.dtype, np.float32)
+        )
+        return np.divide(e_rectified_flux, self.ferre_flux, out=e_rectified_flux)
+
+    def clear_ferre_cache(self):
+        """Drop any pixel arrays that have been loaded for this result."""
+        self.__dict__.pop("_ferre_cache", None)
 
     def unmask(self, array, fill_value=np.nan):
-        unmasked_array = fill_value * np.ones(APOGEE_FERRE_MASK.shape)
+        unmasked_array = np.full(APOGEE_FERRE_MASK.shape, fill_value, dtype=np.result_type(array, fill_value))
         unmasked_array[APOGEE_FERRE_MASK] = array
         return unmasked_array
 
         
-    def _get_input_pixel_array(self, basename):
-        return np.loadtxt(
-            fname=f"{self.pwd}/{basename}",
-            skiprows=int(self.ferre_input_index), 
-            max_rows=1,
-        )
+    def _get_input_pixel_array(self, basename, P=7514):
+        names, data = read_ferre_pixel_file(f"{self.pwd}/{basename}", P=P, has_names=False)
+        return np.asarray(data[int(self.ferre_input_index)])
 
 
     def _get_output_pixel_array(self, basename, P=7514):
         
         #assert self.ferre_input_index >= 0
 
-        kwds = dict(
-            fname=f"{self.pwd}/{basename}",
-            skiprows=int(self.ferre_output_index), 
-            max_rows=1,
-        )
-        '''
-        try:
-            name, = np.atleast_1d(np.loadtxt(usecols=(0, ), dtype=str, **kwds))
-            array = np.loadtxt(usecols=range(1, 1+P), **kwds)
+        names, data = read_ferre_pixel_file(f"{self.pwd}/{basename}", P=P)
+        index = int(self.ferre_output_index)
+        name, array = (names[index], np.asarray(data[index]))
 
+        # The name starts with `{index}_{source_pk}_{spectrum_pk}_`, so we can check it without
+        # parsing. Only parse it if it doesn't match, to say which part is wrong.
+        if not name.startswith(self._ferre_name_prefix):
             meta = parse_ferre_spectrum_name(name)
-            if (
-                (int(meta["source_pk"]) != self.source_pk)
-            or (int(meta["spectrum_pk"]) != self.spectrum_pk)
-            or (int(meta["index"]) != self.ferre_input_index)
-            ):
-                raise a
-        except:
-            del kwds["skiprows"]
-            del kwds["max_rows"]
-
-            name = get_ferre_spectrum_name(self.ferre_input_index, self.source_pk, self.spectrum_pk, self.initial_flags, self.upstream_id)
-
-            index = list(np.loadtxt(usecols=(0, ), dtype=str, **kwds)).index(name)
-            self.ferre_output_index = index
-            self.save()
-            print("saved!")
-            kwds["skiprows"] = index
-            kwds["max_rows"] = 1
-
-            name, = np.atleast_1d(np.loadtxt(usecols=(0, ), dtype=str, **kwds))
-            array = np.loadtxt(usecols=range(1, 1+P), **kwds)
-        '''
-        name, = np.atleast_1d(np.loadtxt(usecols=(0, ), dtype=str, **kwds))
-        array = np.loadtxt(usecols=range(1, 1+P), **kwds)
-
-        meta = parse_ferre_spectrum_name(name)
-        assert int(meta["source_pk"]) == self.source_pk
-        assert int(meta["spectrum_pk"]) == self.spectrum_pk
-        assert int(meta["index"]) == self.ferre_input_index
+            assert int(meta["source_pk"]) == self.source_pk
+            assert int(meta["spectrum_pk"]) == self.spectrum_pk
+            assert int(meta["index"]) == self.ferre_input_index
 
         return array
 
+    @property
+    def _ferre_name_prefix(self):
+        return get_ferre_spectrum_name(self.ferre_input_index, self.source_pk, self.spectrum_pk, "")
+
 
 class FerreCoarse(BaseModel, FerreOutputMixin):
 
@@ -155,16 +161,16 @@ class FerreCoarse(BaseModel, FerreOutputMixin):
     flag_initial_guess_at_grid_center = initial_flags.flag(2**6, help_text="Initial guess from grid center")
 
     #> FERRE Settings
-    continuum_order = IntegerField(default=-1, null=True)
+    continuum_order = SmallIntegerField(default=-1, null=True)
     continuum_reject = FloatField(null=True)
-    continuum_flag = IntegerField(default=0, null=True)
-    continuum_observations_flag = IntegerField(default=0, null=True)
-    interpolation_order = IntegerField(default=-1)
+    continuum_flag = SmallIntegerField(default=0, null=True)
+    continuum_observations_flag = SmallIntegerField(default=0, null=True)
+    interpolation_order = SmallIntegerField(default=-1)
     weight_path = TextField(default="")
     frozen_flags = BitField(default=0)
-    f_access = IntegerField(default=-1)
-    f_format = IntegerField(default=-1)
-    n_threads = IntegerField(default=-1)
+    f_access = SmallIntegerField(default=-1)
+    f_format = SmallIntegerField(default=-1)
+    n_threads = SmallIntegerField(default=-1)
 
     flag_teff_frozen = frozen_flags.flag(2**0, "Effective temperature is frozen")
     flag_logg_frozen = frozen_flags.flag(2**1, "Surface gravity is frozen")
@@ -283,16 +289,16 @@ class FerreStellarParameters(BaseModel, FerreOutputMixin):
     flag_initial_guess_from_user = initial_flags.flag(2**2, help_text="Initial guess specified by user")
 
     #> FERRE Settings
-    continuum_order = IntegerField(default=-1)
+    continuum_order = SmallIntegerField(default=-1)
     continuum_reject = FloatField(null=True)
-    continuum_flag = IntegerField(default=0, null=True)
-    continuum_observations_flag = IntegerField(default=0, null=True)
-    interpolation_order = IntegerField(default=-1)
+    continuum_flag = SmallIntegerField(default=0, null=True)
+    continuum_observations_flag = SmallIntegerField(default=0, null=True)
+    interpolation_order = SmallIntegerField(default=-1)
     weight_path = TextField(default="")
     frozen_flags = BitField(default=0)
-    f_access = IntegerField(default=-1)
-    f_format = IntegerField(default=-1)
-    n_threads = IntegerField(default=-1)
+    f_access = SmallIntegerField(default=-1)
+    f_format = SmallIntegerField(default=-1)
+    n_threads = SmallIntegerField(default=-1)
 
     flag_teff_frozen = frozen_flags.flag(2**0, "Effective temperature is frozen")
     flag_logg_frozen = frozen_flags.flag(2**1, "Surface gravity is frozen")
@@ -381,11 +387,11 @@ class FerreChemicalAbundances(BaseModel, FerreOutputMixin):
 
     # We need to ovverride these from the FerreOutputMixin class because the `flux` and `e_flux`
     # arrays are in the parent directory.
-    @cached_property
+    @_cache_readonly
     def ferre_flux(self):
         return self._get_input_pixel_array("../flux.input")
         
-    @cached_property
+    @_cache_readonly
     def ferre_e_flux(self):
         return self._get_input_pixel_array("../e_flux.input")
     
@@ -420,16 +426,16 @@ class FerreChemicalAbundances(BaseModel, FerreOutputMixin):
     # TODO: Not sure what flag definitions are needed for initial guess.
 
     #> FERRE Settings
-    continuum_order = IntegerField(default=-1)
+    continuum_order = SmallIntegerField(default=-1)
     continuum_reject = FloatField(null=True)
-    continuum_flag = IntegerField(default=0, null=True)
-    continuum_observations_flag = IntegerField(default=0, null=True)
-    interpolation_order = IntegerField(default=-1)
+    continuum_flag = SmallIntegerField(default=0, null=True)
+    continuum_observations_flag = SmallIntegerField(default=0, null=True)
+    interpolation_order = SmallIntegerField(default=-1)
     weight_path = TextField(default="")
     frozen_flags = BitField(default=0)
-    f_access = IntegerField(default=-1)
-    f_format = IntegerField(default=-1)
-    n_threads = IntegerField(default=-1)
+    f_access = SmallIntegerField(default=-1)
+    f_format = SmallIntegerField(default=-1)
+    n_threads = SmallIntegerField(default=-1)
 
     flag_teff_frozen = frozen_flags.flag(2**0, "Effective temperature is frozen")
     flag_logg_frozen = frozen_flags.flag(2**1, "Surface gravity is frozen")
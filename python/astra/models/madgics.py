@@ -1,6 +1,10 @@
 import numpy as np
 import h5py
 import concurrent
+import concurrent.futures
+from functools import lru_cache
+from itertools import repeat
+from multiprocessing import shared_memory
 from peewee import (
     AutoField,
     ForeignKeyField,
@@ -8,6 +12,7 @@ from peewee import (
     TextField
 )
 from tqdm import tqdm
+from astra.utils import log
 from astra.models.base import BaseModel
 from astra.models.source import Source
 from astra.models.spectrum import (Spectrum, SpectrumMixin)
@@ -103,94 +108,249 @@ class ApogeeMADGICSVisitSpectrum(BaseModel, SpectrumMixin):
 
 
 
+@lru_cache(maxsize=None)
+def _pixel_grid(P):
+    # Shared by every spectrum with P pixels, so it is read-only.
+    x = np.arange(P, dtype=float)
+    x.flags.writeable = False
+    return x
+
+
 def resample_apmadgics(spectrum, n_res):       
-    x = np.arange(spectrum.wavelength.size) 
+    x = _pixel_grid(spectrum.wavelength.size)
 
     pixel = wave_to_pixel(x + spectrum.v_rad_pixel, x)
-    (finite, ) = np.where(np.isfinite(pixel))
+    finite = np.isfinite(pixel)
+
+    # Convert ivar to variance once. Pixels with ivar = 0 get infinite variance, so any
+    # output pixel that draws on them also ends up with ivar = 0.
+    flux_var = np.full(spectrum.ivar.shape, np.inf)
+    np.divide(1, spectrum.ivar, out=flux_var, where=(spectrum.ivar > 0))
 
     ((finite_flux, finite_e_flux), ) = sincint(
         pixel[finite], n_res, [
-            [spectrum.flux, 1/spectrum.ivar]
+            [spectrum.flux, flux_var]
         ]
     )
 
-    flux = np.nan * np.ones(spectrum.wavelength.size)
-    e_flux = np.nan * np.ones(spectrum.wavelength.size)
+    # Pixels that shift off the grid are flagged by ivar = 0, as in _resample_rows.
+    flux = np.zeros(spectrum.wavelength.size)
+    ivar = np.zeros(spectrum.wavelength.size)
     flux[finite] = finite_flux
-    e_flux[finite] = finite_e_flux
-    
+    with np.errstate(divide="ignore"):
+        ivar[finite] = finite_e_flux**-2
+    ivar[~np.isfinite(ivar)] = 0
+
     spectrum.flux = flux
-    spectrum.ivar = e_flux**-2
-    bad = ~np.isfinite(spectrum.ivar)
-    spectrum.ivar[bad] = 0
+    spectrum.ivar = ivar
     
     return None
 
 
-def _shift_and_resample_to_rest_frame(index, v_rad, flux, flux_var, n_res=4.25):
-    x = np.arange(flux.size)
-    pixel = wave_to_pixel(x + v_rad, x)
-
-    (finite, ) = np.where(np.isfinite(pixel))
-
-    ((finite_flux, finite_e_flux), ) = sincint(
-        pixel[finite], n_res, [
-            [flux, flux_var]
-        ]
+@lru_cache(maxsize=None)
+def _sinc_kernel_size(n_res):
+    ksize = int(21 * n_res / 2.0)
+    if ksize % 2 == 0:
+        ksize += 1
+    return (ksize, ksize // 2)
+
+
+def _sinc_kernels(fx, n_res):
+    """
+    Return the damped sinc weights that `sincint` uses for each fractional pixel offset.
+
+    The weights depend only on the fractional offset, so they are computed once per
+    spectrum (ksize values) rather than once per output pixel.
+
+    :param fx:
+        The fractional pixel offsets, with shape (B, ).
+
+    :param n_res:
+        The number of pixels per resolution element.
+
+    :returns:
+        An array of kernel weights with shape (B, ksize).
+    """
+    ksize, nhalf = _sinc_kernel_size(n_res)
+    xkernel = (np.arange(ksize) - nhalf - np.asarray(fx)[:, None]) / (n_res / 2.0)
+    u1 = xkernel / (3.25 * n_res / 2.0)
+    u2 = np.pi * xkernel
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sinc = np.exp(-(u1**2)) * np.sin(u2) / u2 / (n_res / 2.0)
+    # The sinc function value at x = 0 is defined by the limit, sin(u2) / u2 -> 1, and it is
+    # scaled by the same 1 / (n_res / 2) as every other weight.
+    sinc[u2 == 0] = 1 / (n_res / 2.0)
+    return sinc
+
+
+def _resample_rows(v_rads, fluxes, e_fluxes, n_res=4.25, flux_offset=0, out=None):
+    """
+    Shift a block of spectra by a (sub-)pixel offset and sinc-resample them onto the
+    original pixel grid.
+
+    This gives the same result as calling `sincint` on each row at the pixel positions
+    `x + v_rad`, which is what `wave_to_pixel(x + v_rad, x)` approximates. Because the
+    pixel grid is uniform, the shift is the same for every pixel in a row, so every
+    output pixel in that row uses the same kernel weights, and each row is resampled
+    with a single correlation.
+
+    :param v_rads:
+        The pixel offset for each spectrum, with shape (B, ).
+
+    :param fluxes:
+        The fluxes to resample, with shape (B, P).
+
+    :param e_fluxes:
+        The flux errors, with shape (B, P).
+
+    :param n_res: [optional]
+        The number of pixels per resolution element (default: 4.25).
+
+    :param flux_offset: [optional]
+        A constant to add to the fluxes before resampling (default: 0).
+
+    :param out: [optional]
+        A two-length tuple of (flux, ivar) arrays with shape (B, P) to write the
+        result to. If `None` is given, new arrays are allocated.
+
+    :returns:
+        A two-length tuple of (flux, ivar) arrays, each with shape (B, P). Pixels that
+        are shifted off the grid have zero flux and zero inverse variance.
+    """
+    fluxes, e_fluxes = (np.atleast_2d(fluxes), np.atleast_2d(e_fluxes))
+    B, P = fluxes.shape
+    v_rads = np.asarray(v_rads, dtype=float).reshape(B)
+
+    ksize, nhalf = _sinc_kernel_size(n_res)
+
+    # Rows without a finite offset are entirely off the grid. Clipping the offset to
+    # +/- P keeps those rows (and any wild offsets) off the grid without a huge pad.
+    v_rads = np.clip(np.where(np.isfinite(v_rads), v_rads, P), -P, P)
+    shifts = np.floor(v_rads)
+    fx = v_rads - shifts
+    shifts = shifts.astype(int)
+
+    sinc = _sinc_kernels(fx, n_res)
+
+    # Zero-pad so that kernel lobes falling off either end of the spectrum contribute nothing.
+    # The flux offset and the error-to-variance conversion are applied while filling the
+    # padded buffers, so no other copies of the inputs are made.
+    pad = nhalf + np.max(np.abs(shifts))
+    padded_fluxes = np.zeros((B, P + 2 * pad))
+    np.add(fluxes, flux_offset, out=padded_fluxes[:, pad:pad + P])
+    padded_flux_vars = np.zeros((B, P + 2 * pad))
+    np.square(e_fluxes, out=padded_flux_vars[:, pad:pad + P])
+
+    flux, ivar = out if out is not None else (np.empty((B, P)), np.empty((B, P)))
+
+    # Each output pixel is a dot product of the row's kernel with a window of the input,
+    # so each row is one compiled correlation over a contiguous slice. Pixels with
+    # x + v_rad outside [0, P - 1] are the runs [0, lo) and [hi, P) at the ends of a row.
+    los = np.clip(np.ceil(-v_rads), 0, P).astype(int)
+    his = np.clip(np.floor(P - 1 - v_rads) + 1, 0, P).astype(int)
+    for b, start in enumerate(shifts + pad - nhalf):
+        end = start + P + ksize - 1
+        flux[b] = np.correlate(padded_fluxes[b, start:end], sinc[b], mode="valid")
+        # Propagate the variance (weights squared) and invert it once. Pixels with zero or
+        # non-finite variance get ivar = 0.
+        flux_var = np.correlate(padded_flux_vars[b, start:end], sinc[b]**2, mode="valid")
+        ivar[b] = 0
+        np.divide(1, flux_var, out=ivar[b], where=(flux_var > 0))
+
+        flux[b, :los[b]] = ivar[b, :los[b]] = 0
+        flux[b, his[b]:] = ivar[b, his[b]:] = 0
+    return (flux, ivar)
+
+
+# Arrays shared with the resampling worker processes, keyed by name, and the HDF5
+# datasets that each worker process opens for itself.
+_shared_arrays = {}
+_datasets = {}
+
+def _create_shared_array(shape, dtype=float):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+    return (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+
+def _initialize_worker(specs, datasets):
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _shared_arrays[key] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    for key, (path, name) in datasets.items():
+        _datasets[key] = h5py.File(path, "r")[name]
+
+
+def _shift_and_resample_to_rest_frame(si, ei, n_res=4.25):
+    arrays = { key: array for key, (shm, array) in _shared_arrays.items() }
+    dtype = arrays["resampled_fluxs"].dtype
+    _resample_rows(
+        arrays["v_rads"][si:ei],
+        _datasets["fluxes"].astype(dtype)[si:ei],
+        _datasets["e_fluxes"].astype(dtype)[si:ei],
+        n_res,
+        flux_offset=1,
+        out=(arrays["resampled_fluxs"][si:ei], arrays["resampled_ivars"][si:ei])
     )
+    return (si, ei)
 
-    finite_ivar = finite_e_flux**-2
-    finite_ivar[~np.isfinite(finite_ivar)] = 0
-
-    resampled_flux = np.zeros_like(flux)
-    resampled_ivar = np.zeros_like(flux)
-    resampled_flux[finite] = finite_flux
-    resampled_ivar[finite] = finite_ivar
-
-    return (index, resampled_flux, resampled_ivar)
 
-
-def shift_and_resample_to_rest_frame(flux_path, flux_err_path, rv_pixoff_path, n_res=4.25, max_workers=4):
+def shift_and_resample_to_rest_frame(flux_path, flux_err_path, rv_pixoff_path, n_res=4.25, max_workers=4, batch_size=512, dtype=np.float32, callback=None):
     import os
-    print("loading flux")
-    flux_fp = h5py.File(flux_path, "r")
-    print("loading err")
-    flux_err_fp = h5py.File(flux_err_path, "r")
-    print("loading rv")
-    rv_pixoff_fp = h5py.File(rv_pixoff_path, "r")
     get_key = lambda x: os.path.basename(x).split(".")[0][14:] 
 
-    print("parsing vrads")
-    v_rads = rv_pixoff_fp[get_key(rv_pixoff_path)]
-    print("parsing fluxes")
-    fluxes = flux_fp[get_key(flux_path)]
-    print("parsing vars")
-    e_fluxes = flux_err_fp[get_key(flux_err_path)]
-    print("done")
-
-    N, P = flux_fp[get_key(flux_path)].shape
-    
-    executor = concurrent.futures.ProcessPoolExecutor(max_workers)
-
-    futures = []
-    for i, (v_rad, flux, e_flux) in enumerate(tqdm(zip(v_rads, fluxes, e_fluxes), total=N, desc="Submitting")):
-        futures.append(
-            executor.submit(_shift_and_resample_to_rest_frame, i, v_rad, 1 + flux, e_flux**2, n_res)
-        )
-
-    print("preparing flux array")
-    resampled_fluxs = np.zeros((N, P), dtype=float)
-    print("prepareing ivar array")
-    resampled_ivars = np.zeros((N, P), dtype=float)
-    print("ok")
-
-    with tqdm(total=N, desc="Resampling in parallel") as pb:
-        for future in concurrent.futures.as_completed(futures):
-            index, resampled_flux, resampled_ivar = future.result()
-            resampled_fluxs[index] = resampled_flux
-            resampled_ivars[index] = resampled_ivar
-            pb.update()
+    with h5py.File(flux_path, "r") as fp:
+        N, P = fp[get_key(flux_path)].shape
+
+    # Each worker opens the flux and flux error files itself and reads only its own rows,
+    # so reads from the two files (and from different blocks) proceed in parallel across
+    # processes rather than through one HDF5 handle in this process. The results are
+    # written in place to shared memory, so only (start, end) row indices are sent
+    # between processes. The pixel arrays are read and stored as `dtype` (float32 by
+    # default) to halve the memory traffic. Resampling itself accumulates in float64.
+    # Everything stays row-major (N, P), as stored in the HDF5 files: each spectrum has its
+    # own kernel and is resampled along its own contiguous pixel axis, so a (P, N) layout
+    # would only turn those stride-1 reads into strided ones.
+    datasets = {
+        "fluxes": (flux_path, get_key(flux_path)),
+        "e_fluxes": (flux_err_path, get_key(flux_err_path)),
+    }
+    shared = {
+        "v_rads": _create_shared_array((N, )),
+        "resampled_fluxs": _create_shared_array((N, P), dtype),
+        "resampled_ivars": _create_shared_array((N, P), dtype),
+    }
+    try:
+        log.info(f"Resampling {N} spectra with {P} pixels from {flux_path}")
+        with h5py.File(rv_pixoff_path, "r") as fp:
+            shared["v_rads"][1][:] = np.ravel(fp[get_key(rv_pixoff_path)][:])
+
+        specs = { key: (shm.name, array.shape, array.dtype) for key, (shm, array) in shared.items() }
+        with concurrent.futures.ProcessPoolExecutor(max_workers, initializer=_initialize_worker, initargs=(specs, datasets)) as executor:
+            starts = range(0, N, batch_size)
+            ends = [min(N, si + batch_size) for si in starts]
+            results = executor.map(
+                _shift_and_resample_to_rest_frame,
+                starts,
+                ends,
+                repeat(n_res),
+                chunksize=max(1, len(starts) // (max_workers * 8))
+            )
+            with tqdm(total=N, desc="Resampling in parallel", mininterval=1.0, smoothing=0.01) as pb:
+                for si, ei in results:
+                    # The arrays given to `callback` are views of shared memory that is
+                    # released when this function returns, so callbacks must copy them.
+                    if callback is not None:
+                        callback(si, shared["resampled_fluxs"][1][si:ei], shared["resampled_ivars"][1][si:ei])
+                    pb.update(ei - si)
+
+        resampled_fluxs = np.array(shared["resampled_fluxs"][1])
+        resampled_ivars = np.array(shared["resampled_ivars"][1])
+    finally:
+        for key in list(shared):
+            shm, array = shared.pop(key)
+            del array
+            shm.close()
+            shm.unlink()
                 
     return resampled_fluxs, resampled_ivars
 
@@ -199,27 +359,46 @@ def shift_and_resample_to_rest_frame(flux_path, flux_err_path, rv_pixoff_path, n
 
 if __name__ == "__main__":
 
-    from astropy.table import Table
-    from tqdm import tqdm
-
-    resampled_flux, resampled_ivar = shift_and_resample_to_rest_frame(
-        "/uufs/chpc.utah.edu/common/home/u6039752/scratch1/working/2023_07_21/outdir_wu_K/apMADGICS_out_x_starLines_v0.h5",
-        "/uufs/chpc.utah.edu/common/home/u6039752/scratch1/working/2023_07_21/outdir_wu_K/apMADGICS_out_x_starLines_err_v0.h5",
-        "/uufs/chpc.utah.edu/common/home/u6039752/scratch1/working/2023_07_21/outdir_wu_K/apMADGICS_out_RV_pixoff_final.h5"
-    )    
-
-    # Clip off the first 125 pixels in order to match the apStar/FERRE sampling
-    si = 125
     import os
-    resampled_flux = resampled_flux[:, si:]
-    resampled_ivar = resampled_ivar[:, si:]
     from astropy.io import fits
+
     output_dir = "/uufs/chpc.utah.edu/common/home/sdss50/sdsswork/users/u6020307/apMADGICS_20230721_Konventional/"
     os.makedirs(output_dir, exist_ok=True)
 
-    N, P = resampled_flux.shape
-    for i in range(N):
-        Table(data=dict(flux=resampled_flux[i], ivar=resampled_ivar[i])).write(f"{output_dir}/apMADGICS-20230721-{i}.fits", overwrite=True)
+    # Clip off the first 125 pixels in order to match the apStar/FERRE sampling
+    si = 125
+
+    # The output is one file per spectrum. The files for each resampled block are written
+    # from a thread pool while later blocks are still being resampled.
+    def write_spectra(start, flux, ivar):
+        for i, (f, iv) in enumerate(zip(flux, ivar), start=start):
+            hdu = fits.BinTableHDU.from_columns([
+                fits.Column(name="flux", format="E", array=f),
+                fits.Column(name="ivar", format="E", array=iv),
+            ])
+            hdu.writeto(f"{output_dir}/apMADGICS-20230721-{i}.fits", overwrite=True, checksum=False, output_verify="ignore")
+
+    with concurrent.futures.ThreadPoolExecutor(4) as writer:
+        writes = []
+        def write_block(start, flux, ivar, rows_per_write=32):
+            for i in range(0, flux.shape[0], rows_per_write):
+                writes.append(
+                    writer.submit(
+                        write_spectra,
+                        start + i,
+                        np.array(flux[i:i + rows_per_write, si:]),
+                        np.array(ivar[i:i + rows_per_write, si:])
+                    )
+                )
+
+        shift_and_resample_to_rest_frame(
+            "/uufs/chpc.utah.edu/common/home/u6039752/scratch1/working/2023_07_21/outdir_wu_K/apMADGICS_out_x_starLines_v0.h5",
+            "/uufs/chpc.utah.edu/common/home/u6039752/scratch1/working/2023_07_21/outdir_wu_K/apMADGICS_out_x_starLines_err_v0.h5",
+            "/uufs/chpc.utah.edu/common/home/u6039752/scratch1/working/2023_07_21/outdir_wu_K/apMADGICS_out_RV_pixoff_final.h5",
+            callback=write_block
+        )
+        for future in tqdm(concurrent.futures.as_completed(writes), total=len(writes), desc="Writing"):
+            future.result()
 
     '''
     from astropy.table import Table
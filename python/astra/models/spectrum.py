@@ -8,6 +8,25 @@ import numpy as np
 
 
 
+def _steps_mid(x, y):
+    """
+    Return the vertices of a `drawstyle="steps-mid"` line through each row of `x` and `y`.
+
+    :param x:
+        The x values, with shape (N, P).
+
+    :param y:
+        The y values, with shape (N, P).
+
+    :returns:
+        A two-length tuple of x and y vertices, each with shape (N, 2 * P).
+    """
+    mid = 0.5 * (x[:, 1:] + x[:, :-1])
+    xs = np.concatenate([x[:, :1], np.repeat(mid, 2, axis=1), x[:, -1:]], axis=1)
+    ys = np.repeat(y, 2, axis=1)
+    return (xs, ys)
+
+
 class SpectrumMixin(object):
 
     def plot(self, rectified=False, plot_model=False, figsize=(8, 3), ylim_percentile=(1, 99)):
@@ -15,69 +34,80 @@ class SpectrumMixin(object):
             warnings.simplefilter("ignore")
 
             import matplotlib.pyplot as plt        
+            from matplotlib.collections import LineCollection
+            # Look up the arrays on the concrete spectrum, so that a `Spectrum` pointer is
+            # resolved once and not sent through `__getattr__` for every probe.
+            spectrum = self.ref if isinstance(self, Spectrum) else self
+
             # to gracefully handle apVisits
-            x = np.atleast_2d(self.wavelength)
-            y = np.atleast_2d(self.flux) 
+            x = np.atleast_2d(spectrum.wavelength)
+            y = np.atleast_2d(spectrum.flux)
             try:
-                y_err = np.atleast_2d(self.e_flux)
+                e_flux = getattr(spectrum, "e_flux", None)
+                if e_flux is None:
+                    ivar = getattr(spectrum, "ivar", None)
+                    if ivar is not None:
+                        ivar = np.asarray(ivar, dtype=float)
+                        e_flux = np.full(ivar.shape, np.nan)
+                        np.power(ivar, -0.5, out=e_flux, where=(ivar > 0))
             except:
-                    try:
-                        y_err = np.atleast_2d(self.ivar)**-0.5
-                    except:
-                        y_err = np.nan * np.ones_like(self.flux)
-            
-            continuum, is_rectified = (1, False)
-            if rectified:            
-                try:
-                    for key in ("continuum", "nmf_continuum"):
-                        continuum = getattr(self, key, None)
-                        if continuum is not None:
-                            is_rectified = True
-                            break
-                    else:
-                        log.warning(f"Cannot find continuum for spectrum {self}")
-                        continuum = 1
-                except:
-                    log.exception(f"Exception when trying to get continum for spectrum {self}")
+                e_flux = None
+            y_err = np.nan * np.ones_like(y) if e_flux is None else np.atleast_2d(e_flux)
 
-            has_model_flux = False
-            if plot_model:            
+            continuum, is_rectified, has_model_flux = (1, False, False)
+            if rectified or plot_model:
                 try:
-                    for key in ("model_flux", "nmf_model_flux"):
-                        model_flux = getattr(self, key, None)
-                        if model_flux is not None:
-                            has_model_flux = True
-                            break
-                    else:
-                        log.warning(f"No model flux found for spectrum {self}")
+                    if rectified:
+                        for key in ("continuum", "nmf_continuum"):
+                            continuum = getattr(spectrum, key, None)
+                            if continuum is not None:
+                                is_rectified = True
+                                break
+                        else:
+                            log.warning(f"Cannot find continuum for spectrum {self}")
+                            continuum = 1
+
+                    if plot_model:
+                        for key in ("model_flux", "nmf_model_flux"):
+                            model_flux = getattr(spectrum, key, None)
+                            if model_flux is not None:
+                                has_model_flux = True
+                                break
+                        else:
+                            log.warning(f"No model flux found for spectrum {self}")
                 except:
-                    log.exception(f"Exception when trying to get model flux for spectrum {self}")
+                    log.exception(f"Exception when trying to get continuum or model flux for spectrum {self}")
 
             N, P = y.shape
             
             fig, ax = plt.subplots(figsize=figsize)
-            for i in range(N):
-                label = None
-                if i == 0:
-                    try:
-                        for k in ("spectrum_pk", "pk", "task_pk"):
-                            v = getattr(self, k, None)
-                            if v is not None:
-                                label = f"{k}={v}"
-                    except:
-                        None
-                            
-                ax.plot(
-                    x[i],
-                    y[i] / continuum,
-                    c='k',
+
+            label = None
+            try:
+                for k in ("spectrum_pk", "pk", "task_pk"):
+                    v = getattr(self, k, None)
+                    if v is not None:
+                        label = f"{k}={v}"
+            except:
+                None
+
+            # Normalise all rows at once, and draw the spectra as one collection.
+            y_norm = y / continuum
+            y_err_norm = y_err / continuum
+            ax.add_collection(
+                LineCollection(
+                    np.stack(_steps_mid(np.broadcast_to(x, y_norm.shape), y_norm), axis=-1),
+                    colors="k",
                     label=label,
-                    drawstyle="steps-mid"
                 )
+            )
+            for i in range(N):
+                # fill_between splits the fill at non-finite values, which a single
+                # PolyCollection would not.
                 ax.fill_between(
                     x[i],
-                    (y[i] - y_err[i])/continuum,
-                    (y[i] + y_err[i])/continuum,
+                    y_norm[i] - y_err_norm[i],
+                    y_norm[i] + y_err_norm[i],
                     step="mid",
                     facecolor="#cccccc",
                     zorder=-1                
@@ -86,7 +116,7 @@ class SpectrumMixin(object):
             if has_model_flux:
                 try:
                     ax.plot(
-                        self.wavelength,
+                        spectrum.wavelength,
                         model_flux / continuum,
                         c="tab:red"
                     )
@@ -108,6 +138,35 @@ class SpectrumMixin(object):
             fig.tight_layout()
             return fig
 
+# The bit of `Spectrum.spectrum_type_flags` that records which table each spectrum is in,
+# keyed by model name (to avoid importing the spectrum models here).
+SPECTRUM_TYPE_FLAGS = {
+    "ApogeeVisitSpectrum": 2**0,
+    "ApogeeVisitSpectrumInApStar": 2**1,
+    "ApogeeCoaddedSpectrumInApStar": 2**2,
+    "BossVisitSpectrum": 2**3,
+    "BossCoaddedSpectrum": 2**4,
+    "ApogeeMADGICSVisitSpectrum": 2**5,
+}
+
+
+def get_spectrum_type_flag(model):
+    """
+    Return the `Spectrum.spectrum_type_flags` bit for a spectrum model, or 0 if it has none.
+
+    :param model:
+        The spectrum model class, or `None`.
+    """
+    return 0 if model is None else SPECTRUM_TYPE_FLAGS.get(model.__name__, 0)
+
+
+def _forward_to_ref(name):
+    return property(
+        lambda self: getattr(self.ref, name),
+        doc=f"The `{name}` of the spectrum that this pointer resolves to."
+    )
+
+
 class Spectrum(BaseModel, SpectrumMixin):
 
     """ A one dimensional spectrum. """
@@ -115,7 +174,23 @@ class Spectrum(BaseModel, SpectrumMixin):
     pk = AutoField()
     spectrum_type_flags = BitField(default=0)
 
+    # The attributes used most often are forwarded explicitly, so that they skip the
+    # `__getattr__` fallback.
+    wavelength = _forward_to_ref("wavelength")
+    flux = _forward_to_ref("flux")
+    ivar = _forward_to_ref("ivar")
+    pixel_flags = _forward_to_ref("pixel_flags")
+
     def resolve(self):
+        # If the spectrum type was recorded when the spectrum was created, go straight
+        # to that table. Otherwise, search every table that references this spectrum.
+        if self.spectrum_type_flags:
+            for field, model in self._meta.backrefs.items():
+                if get_spectrum_type_flag(model) & self.spectrum_type_flags:
+                    spectrum = model.get_or_none(field == self.pk)
+                    if spectrum is not None:
+                        return spectrum
+
         for expression, field in self.dependencies():
             if SpectrumMixin not in field.model.__mro__:
                 continue
@@ -134,6 +209,10 @@ class Spectrum(BaseModel, SpectrumMixin):
         return self.resolve()
     
     def __getattr__(self, attr):
+        # Private and special names (e.g., probes from copy, pickle, or peewee internals)
+        # are never forwarded, so they fail fast without resolving the spectrum.
+        if attr.startswith("_"):
+            raise AttributeError(attr)
         # Resolve to reference attribute
         return getattr(self.ref, attr)
     
@@ -10,13 +10,22 @@ class SlurmSensor(BaseSensorOperator):
         self.job_ids = job_ids
         return None
 
+    def parse_job_ids(self):
+        """Parse the (rendered) job identifiers, given as a space-separated or JSON-encoded list."""
+        try:
+            return set(map(int, self.job_ids.split(" ")))
+        except (AttributeError, ValueError):
+            return set(map(int, json.loads(self.job_ids)))
+
     def poke(self, context):
+        # `job_ids` is a templated field, so it is rendered by the time we poke, but it does not
+        # change between pokes. Only parse it once.
         try:
-            job_ids = set(map(int, self.job_ids.split(" ")))
-        except:
+            job_ids = self._job_ids
+        except AttributeError:
             try:
-                job_ids = set(map(int, json.loads(self.job_ids)))
-            except:
+                job_ids = self._job_ids = self.parse_job_ids()
+            except (TypeError, ValueError):
                 print(f"No valid job IDs given: ({type(self.job_ids)}) {self.job_ids}")
                 print(f"Returning success because no job identifier(s) to wait on")
                 return True
@@ -3,11 +3,12 @@ import numpy as np
 from datetime import datetime
 from tempfile import mkdtemp
 from typing import Optional, Iterable, List, Tuple, Callable, Union
-from peewee import JOIN, fn
+from peewee import JOIN, fn, ModelSelect
 from tqdm import tqdm
 
 from astra import __version__, task
 from astra.utils import log, expand_path
+from astra.models.base import database
 from astra.models.aspcap import ASPCAP, FerreCoarse, FerreStellarParameters, FerreChemicalAbundances
 from astra.models.spectrum import Spectrum, SpectrumMixin
 from astra.pipelines.aspcap.initial import get_initial_guesses
@@ -15,6 +16,9 @@ from astra.pipelines.aspcap.coarse import coarse_stellar_parameters, post_coarse
 from astra.pipelines.aspcap.stellar_parameters import stellar_parameters, post_stellar_parameters
 from astra.pipelines.aspcap.abundances import abundances, get_species, post_abundances
 from astra.pipelines.aspcap.utils import ABUNDANCE_RELATIVE_TO_H
+
+# (t_elapsed, ferre_time_elapsed) for spectra without any coarse results.
+NO_COARSE_TIMING = (0, 0)
         
 
 
@@ -94,9 +98,8 @@ def aspcap(
         )
     )
 
-    # Here we don't need list() because the stellar parameter results will get processed first
-    # in the `create_aspcap_results` function, and then the chemical abundance results.
-    # TODO: This might become a bit of a clusterfuck if the FERRE jobs fail. Maybe revisit this.
+    # The stellar parameter results are iterated over twice in `create_aspcap_results`, so they
+    # need to be a list. 
     stellar_parameter_results = list(stellar_parameters(
         spectra,
         parent_dir=parent_dir,
@@ -105,13 +108,17 @@ def aspcap(
         **kwargs
     ))
 
-    chemical_abundance_results = list(abundances(
+    # Here we don't need list() because the stellar parameter results will get processed first
+    # in the `create_aspcap_results` function, and then the chemical abundance results are 
+    # consumed lazily, one at a time, without keeping them all in memory.
+    # TODO: This might become a bit of a clusterfuck if the FERRE jobs fail. Maybe revisit this.
+    chemical_abundance_results = abundances(
         spectra,
         parent_dir=parent_dir,
         element_weight_paths=element_weight_paths,
         operator_kwds=operator_kwds,
         **kwargs
-    ))
+    )
     yield from create_aspcap_results(stellar_parameter_results, chemical_abundance_results)
 
 
@@ -160,6 +167,12 @@ def create_aspcap_results(
         An iterable of `FerreChemicalAbundances`
     """
 
+    if isinstance(stellar_parameter_results, ModelSelect):
+        # Let the database do this as a sub-query, instead of sending back a (possibly huge) IN list.
+        spectrum_pks = stellar_parameter_results.select(stellar_parameter_results.model.spectrum_pk)
+    else:
+        spectrum_pks = [ea.spectrum_pk for ea in stellar_parameter_results]
+
     t_coarse = (
         FerreCoarse
         .select(
@@ -167,7 +180,7 @@ def create_aspcap_results(
             fn.sum(FerreCoarse.t_elapsed),        
             fn.sum(FerreCoarse.ferre_time_elapsed)
         )
-        .where(FerreCoarse.spectrum_pk.in_([ea.spectrum_pk for ea in stellar_parameter_results]))
+        .where(FerreCoarse.spectrum_pk.in_(spectrum_pks))
         .group_by(FerreCoarse.spectrum_pk)
         .tuples()
     )
@@ -176,23 +189,27 @@ def create_aspcap_results(
     data, ferre_time_elapsed, t_elapsed = ({}, {}, {})
 
     for result in tqdm(stellar_parameter_results, desc="Collecting stellar parameters"):
-        data.setdefault(result.task_pk, {})
+        task_pk = result.task_pk
+        kwds = data.setdefault(task_pk, {})
 
-        t_elapsed.setdefault(result.task_pk, 0)
-        t_elapsed[result.task_pk] += (result.t_elapsed or 0) + (t_coarse.get(result.spectrum_pk, [0])[0] or 0)
-        ferre_time_elapsed.setdefault(result.task_pk, 0)
-        ferre_time_elapsed[result.task_pk] += (result.ferre_time_elapsed or 0) + (t_coarse.get(result.spectrum_pk, [0])[-1] or 0)
+        coarse_timing = t_coarse.get(result.spectrum_pk, NO_COARSE_TIMING)
+        task_t_elapsed = t_elapsed[task_pk] = (
+            t_elapsed.get(task_pk, 0) + (result.t_elapsed or 0) + (coarse_timing[0] or 0)
+        )
+        task_ferre_time_elapsed = ferre_time_elapsed[task_pk] = (
+            ferre_time_elapsed.get(task_pk, 0) + (result.ferre_time_elapsed or 0) + (coarse_timing[-1] or 0)
+        )
         
         v_sini = 10**(result.log10_v_sini or np.nan)
         e_v_sini = (result.e_log10_v_sini or np.nan) * v_sini * np.log(10)
         v_micro = 10**(result.log10_v_micro or np.nan)
         e_v_micro = (result.e_log10_v_micro or np.nan) * v_micro * np.log(10)
 
-        data[result.task_pk].update({
+        kwds.update({
             "source_pk": result.source_pk,
             "spectrum_pk": result.spectrum_pk,
             "tag": result.tag,
-            "t_elapsed": t_elapsed[result.task_pk],
+            "t_elapsed": task_t_elapsed,
             "short_grid_name": result.short_grid_name,
             "teff": result.teff,
             "e_teff": result.e_teff,
@@ -220,8 +237,8 @@ def create_aspcap_results(
             "rchi2": result.rchi2,
             "ferre_flags": result.ferre_flags,
             "ferre_log_snr_sq": result.ferre_log_snr_sq,     
-            "ferre_time_elapsed": ferre_time_elapsed[result.task_pk],
-            "stellar_parameters_task_pk": result.task_pk,
+            "ferre_time_elapsed": task_ferre_time_elapsed,
+            "stellar_parameters_task_pk": task_pk,
 
             "raw_teff": result.teff,
             "raw_e_teff": result.e_teff,
@@ -264,6 +281,7 @@ def create_aspcap_results(
         )
         chemical_abundance_task_pk_names = [f for f in ASPCAP._meta.fields.keys() if f.endswith("_task_pk") and f != "stellar_parameters_task_pk"]
         
+        updated_results, updated_field_names = ([], set())
         for result in q:
             any_update_made = False
             chemical_abundance_task_pks = dict(zip(chemical_abundance_task_pk_names, [getattr(result, f) for f in chemical_abundance_task_pk_names]))            
@@ -274,10 +292,17 @@ def create_aspcap_results(
                 any_update_made = True
                 for k, v in _result_to_kwds(chemical_abundance_result, result.__data__).items():
                     setattr(result, k, v)
+                    updated_field_names.add(k)
 
             if any_update_made:
-                log.info(f"Saving result {result}")                
-                result.save()
+                updated_results.append(result)
+
+        # Update all the changed results together, rather than one `save()` per result.
+        fields = [ASPCAP._meta.fields[k] for k in updated_field_names if k in ASPCAP._meta.fields]
+        if updated_results and fields:
+            log.info(f"Updating {len(updated_results)} existing ASPCAP results")
+            with database.atomic():
+                ASPCAP.bulk_update(updated_results, fields=fields, batch_size=500)
 
     for stellar_parameter_task_pk, kwds in data.items():
         yield ASPCAP(**kwds)
@@ -13,7 +13,7 @@ from astra.models.aspcap import FerreStellarParameters, FerreChemicalAbundances
 from astra.pipelines.ferre.operator import FerreOperator, FerreMonitoringOperator
 from astra.pipelines.ferre.pre_process import pre_process_ferre
 from astra.pipelines.ferre.post_process import post_process_ferre
-from astra.pipelines.ferre.utils import (get_apogee_pixel_mask, parse_ferre_spectrum_name, read_ferre_headers, parse_header_path, get_input_spectrum_primary_keys)
+from astra.pipelines.ferre.utils import (get_apogee_pixel_mask, parse_ferre_spectrum_name, read_ferre_headers, parse_header_path, get_input_spectrum_primary_keys, read_ferre_pixel_file)
 from astra.pipelines.aspcap.utils import (get_input_nml_paths, get_abundance_keywords, sanitise_parent_dir)
 
 STAGE = "abundances"
@@ -296,17 +296,15 @@ def plan_abundances(
             )
         """
 
-        # This does the same as the intent above, but it's faster.
-        # TODO: Consider rewriting the FerreOutputMixin to cache flux arrays and then only return index
-        #       as it is called. That would be the same as the intent above, but it would be faster.
+        # This does the same as the intent above, but it's faster: the continuum is computed for
+        # every spectrum in the working directory at once, and each FERRE file is read only once.
         try:
             continuum_cache[result.pwd]
-        except:
-            P = 7514
-            rectified_model_flux = np.atleast_2d(np.loadtxt(f"{result.pwd}/rectified_model_flux.output", usecols=range(1, 1+P)))
-            model_flux = np.atleast_2d(np.loadtxt(f"{result.pwd}/model_flux.output", usecols=range(1, 1+P)))
-            rectified_flux = np.atleast_2d(np.loadtxt(f"{result.pwd}/rectified_flux.output", usecols=range(1, 1+P)))
-            ferre_flux = np.atleast_2d(np.loadtxt(f"{result.pwd}/flux.input", usecols=range(P)))
+        except KeyError:
+            model_flux_names, model_flux = read_ferre_pixel_file(f"{result.pwd}/model_flux.output")
+            rectified_model_flux_names, rectified_model_flux = read_ferre_pixel_file(f"{result.pwd}/rectified_model_flux.output")
+            rectified_flux_names, rectified_flux = read_ferre_pixel_file(f"{result.pwd}/rectified_flux.output")
+            _, ferre_flux = read_ferre_pixel_file(f"{result.pwd}/flux.input", has_names=False)
 
             continuum = (rectified_model_flux/model_flux) / (rectified_flux/ferre_flux)
             continuum_cache[result.pwd] = np.nan * np.ones((continuum.shape[0], 8575))
@@ -314,9 +312,9 @@ def plan_abundances(
 
             # Check names
             continuum_cache_names[result.pwd] = [
-                np.atleast_1d(np.loadtxt(f"{result.pwd}/model_flux.output", usecols=(0, ), dtype=str)),
-                np.atleast_1d(np.loadtxt(f"{result.pwd}/rectified_flux.output", usecols=(0, ), dtype=str)),
-                np.atleast_1d(np.loadtxt(f"{result.pwd}/rectified_model_flux.output", usecols=(0, ), dtype=str)),
+                model_flux_names,
+                rectified_flux_names,
+                rectified_model_flux_names,
             ]    
 
         finally:
@@ -9,9 +9,9 @@ from astra.utils import log, expand_path, list_to_dict
 from astra.pipelines.ferre.operator import FerreOperator, FerreMonitoringOperator
 from astra.pipelines.ferre.pre_process import pre_process_ferre
 from astra.pipelines.ferre.post_process import post_process_ferre
-from astra.pipelines.ferre.utils import (execute_ferre, parse_header_path, read_ferre_headers, clip_initial_guess)
+from astra.pipelines.ferre.utils import (execute_ferre, parse_header_path, read_ferre_headers, clip_initial_guess, materialize_ferre_pixel_files)
 from astra.pipelines.aspcap.utils import (approximate_log10_microturbulence, get_input_nml_paths, yield_suitable_grids)
-from astra.pipelines.aspcap.initial import get_initial_guesses
+from astra.pipelines.aspcap.initial import get_initial_guesses, INITIAL_FLAGS_AT_GRID_CENTER
 
 #from astra.tools.continuum import Continuum, Scalar
 
@@ -138,21 +138,32 @@ def pre_coarse_stellar_parameters(
 
 
 @task
-def post_coarse_stellar_parameters(parent_dir, **kwargs) -> Iterable[FerreCoarse]:
+def post_coarse_stellar_parameters(parent_dir, materialize_pixel_files=False, **kwargs) -> Iterable[FerreCoarse]:
     """
     Collect the results from FERRE and create database entries for the coarse stellar parameter determination step.
 
     :param parent_dir:
         The parent directory where these FERRE executions were planned.
+    
+    :param materialize_pixel_files: [optional]
+        Convert the FERRE pixel files to binary sidecar files after post-processing, so that
+        the next stage can memory-map them instead of parsing text. This roughly doubles the
+        disk space used by each working directory.
     """
 
-    for pwd in map(os.path.dirname, get_input_nml_paths(parent_dir, STAGE)):
+    pwds = list(map(os.path.dirname, get_input_nml_paths(parent_dir, STAGE)))
+    for pwd in pwds:
         log.info("Post-processing FERRE results in {0}".format(pwd))
         for kwds in post_process_ferre(pwd):
             result = FerreCoarse(**kwds)
             penalize_coarse_stellar_parameter_result(result)
             yield result
 
+    if materialize_pixel_files:
+        # Post-processing re-writes the pixel files, so convert them to binary sidecars now for 
+        # the next stage to read.
+        materialize_ferre_pixel_files(pwds)
+
 
 def penalize_coarse_stellar_parameter_result(result: FerreCoarse, warn_multiplier=5, bad_multiplier=10, fail_multiplier=20, cool_star_in_gk_grid_multiplier=10):
     """
@@ -257,7 +268,7 @@ def plan_coarse_stellar_parameters(
         else:
             # No suitable initial guess has been found.
             # Send it to all grids, at the grid centers.
-            initial_flags = FerreCoarse(flag_initial_guess_at_grid_center=True).initial_flags 
+            initial_flags = INITIAL_FLAGS_AT_GRID_CENTER
             assert initial_flags > 0, "Have the initial flag definitions changed for `astra.models.aspcap.FerreCoarse`?"
 
             log.warning(f"No suitable initial guess found for {spectrum} (from inputs {input_initial_guess}). Starting at all grid centers.")
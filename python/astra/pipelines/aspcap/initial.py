@@ -5,7 +5,13 @@ from astra.models.apogeenet import ApogeeNet
 from astra.models.aspcap import FerreCoarse
 from astra.pipelines.aspcap.utils import approximate_log10_microturbulence 
 
-from peewee import ModelSelect
+from peewee import ModelSelect, chunked
+
+# These are constant, so compute them once instead of creating a model instance for every spectrum.
+INITIAL_FLAGS_FROM_APOGEENET = FerreCoarse(flag_initial_guess_from_apogeenet=True).initial_flags
+INITIAL_FLAGS_FROM_DOPPLER = FerreCoarse(flag_initial_guess_from_doppler=True).initial_flags
+INITIAL_FLAGS_FROM_GAIA_XP_ZHANG_2023 = FerreCoarse(flag_initial_guess_from_gaia_xp_zhang_2023=True).initial_flags
+INITIAL_FLAGS_AT_GRID_CENTER = FerreCoarse(flag_initial_guess_at_grid_center=True).initial_flags
 
 def get_effective_fiber(spectrum):
     for field_name in ("fiber", "mean_fiber"):
@@ -36,7 +42,7 @@ def get_initial_guess_from_gaia_xp_zhang_2023(spectrum):
             "teff": spectrum.source.zgr_teff,
             "logg": spectrum.source.zgr_logg,
             "m_h": spectrum.source.zgr_fe_h,
-            "initial_flags": FerreCoarse(flag_initial_guess_from_gaia_xp_zhang_2023=True).initial_flags
+            "initial_flags": INITIAL_FLAGS_FROM_GAIA_XP_ZHANG_2023
         }
         initial_guess.update(get_initial_defaults(spectrum, spectrum.source.zgr_logg))
         return initial_guess
@@ -44,12 +50,15 @@ def get_initial_guess_from_gaia_xp_zhang_2023(spectrum):
         return None
 
 
-def get_initial_guesses(spectra):
+def get_initial_guesses(spectra, batch_size=1000):
     """
     Get an initial guess of the stellar parameters for ASPCAP, given some spectra.
 
     :param spectra:
         An iterable of spectra.
+    
+    :param batch_size: [optional]
+        The number of spectra to look up existing results for in a single query.
     """
 
     if False and isinstance(spectra, ModelSelect):
@@ -69,7 +78,7 @@ def get_initial_guesses(spectra):
                 "teff": spectrum.initial_teff,
                 "logg": spectrum.initial_logg,
                 "m_h": spectrum.initial_fe_h,
-                "initial_flags": FerreCoarse(flag_initial_guess_from_apogeenet=True).initial_flags,
+                "initial_flags": INITIAL_FLAGS_FROM_APOGEENET,
                 "mean_fiber": fits.getval(spectrum.absolute_path, "MEANFIB"),
                 "telescope": spectrum.telescope,
                 "alpha_m": 0.0,
@@ -81,72 +90,85 @@ def get_initial_guesses(spectra):
             yield (spectrum, initial_guess)
 
     else:         
-        for spectrum in spectra:
+        for chunk in chunked(spectra, batch_size):
+            # Fetch the APOGEENet results for the whole chunk at once, instead of one query per spectrum.
+            apogeenet_results = {}
+            q = (
+                ApogeeNet
+                .select()
+                .where(
+                    (ApogeeNet.result_flags == 0)
+                &   (ApogeeNet.spectrum_pk.in_([spectrum.spectrum_pk for spectrum in chunk]))
+                )
+            )
+            for r in q:
+                apogeenet_results.setdefault(r.spectrum_pk, r)
 
-            # Zhang et al. (2023)
-            initial_guess = get_initial_guess_from_gaia_xp_zhang_2023(spectrum)
-            if initial_guess is not None:
-                yield (spectrum, initial_guess)
+            for spectrum in chunk:
+
+                # Zhang et al. (2023)
+                initial_guess = get_initial_guess_from_gaia_xp_zhang_2023(spectrum)
+                if initial_guess is not None:
+                    yield (spectrum, initial_guess)
 
-            # APOGEENet
-            try:
-                r = ApogeeNet.get(result_flags=0, spectrum_pk=spectrum.spectrum_pk)
-            except ApogeeNet.DoesNotExist:
-                # Revert to Doppler by matching to DRP spectrum identifier.
-                try:
-                    r = (
-                        ApogeeVisitSpectrum
-                        .select()
-                        .where(
-                            (ApogeeVisitSpectrum.spectrum_pk == spectrum.drp_spectrum_pk)
-                        &   (ApogeeVisitSpectrum.doppler_teff >= 2000)
-                        &   (ApogeeVisitSpectrum.doppler_teff <= 100_000)
+                # APOGEENet
+                r = apogeenet_results.get(spectrum.spectrum_pk, None)
+                if r is None:
+                    # Revert to Doppler by matching to DRP spectrum identifier.
+                    try:
+                        r = (
+                            ApogeeVisitSpectrum
+                            .select()
+                            .where(
+                                (ApogeeVisitSpectrum.spectrum_pk == spectrum.drp_spectrum_pk)
+                            &   (ApogeeVisitSpectrum.doppler_teff >= 2000)
+                            &   (ApogeeVisitSpectrum.doppler_teff <= 100_000)
+                            )
+                            .first()
                         )
-                        .first()
-                    )
-                except ApogeeVisitSpectrum.DoesNotExist:
-                    raise
-                except:  
-                    # Get Doppler result for anything matching by source.              
-                    r = (
-                        ApogeeVisitSpectrum
-                        .select()
-                        .where(
-                            (ApogeeVisitSpectrum.source_pk == spectrum.source_pk)
-                        &   (ApogeeVisitSpectrum.doppler_teff >= 2000)
-                        &   (ApogeeVisitSpectrum.doppler_teff <= 100_000)
+                    except ApogeeVisitSpectrum.DoesNotExist:
+                        raise
+                    except:  
+                        # Get Doppler result for anything matching by source.              
+                        r = (
+                            ApogeeVisitSpectrum
+                            .select()
+                            .where(
+                                (ApogeeVisitSpectrum.source_pk == spectrum.source_pk)
+                            &   (ApogeeVisitSpectrum.doppler_teff >= 2000)
+                            &   (ApogeeVisitSpectrum.doppler_teff <= 100_000)
+                            )
+                            .first()
                         )
-                        .first()
-                    )
-                finally:
-                    if r is None:
-                        # Try load it from the headers maybe
-                        continue
+                    finally:
+                        if r is None:
+                            # Try load it from the headers maybe
+                            continue
+                        params = {
+                            "teff": r.doppler_teff,
+                            "logg": r.doppler_logg,
+                            "m_h": r.doppler_fe_h,
+                            "initial_flags": INITIAL_FLAGS_FROM_DOPPLER
+                        }
+                else:
                     params = {
-                        "teff": r.doppler_teff,
-                        "logg": r.doppler_logg,
-                        "m_h": r.doppler_fe_h,
-                        "initial_flags": FerreCoarse(flag_initial_guess_from_doppler=True).initial_flags
+                        "teff": r.teff,
+                        "logg": r.logg,
+                        "m_h": r.m_h,
+                        "initial_flags": INITIAL_FLAGS_FROM_APOGEENET
                     }
-            else:
-                params = {
-                    "teff": r.teff,
-                    "logg": r.logg,
-                    "m_h": r.m_h,
-                    "initial_flags": FerreCoarse(flag_initial_guess_from_apogeenet=True).initial_flags
-                }
-            
-            mean_fiber = get_effective_fiber(spectrum)
+                
+                mean_fiber = get_effective_fiber(spectrum)
 
-            initial_guess = {
-                "telescope": spectrum.telescope,
-                "mean_fiber": mean_fiber,
-                "alpha_m": 0.0,
-                "log10_v_sini": 1.0,
-                "c_m": 0.0,
-                "n_m": 0.0, 
-            }
-            initial_guess.update(params)
-            initial_guess["log10_v_micro"] = approximate_log10_microturbulence(initial_guess["logg"])
+                initial_guess = {
+                    "telescope": spectrum.telescope,
+                    "mean_fiber": mean_fiber,
+                    "alpha_m": 0.0,
+                    "log10_v_sini": 1.0,
+                    "c_m": 0.0,
+                    "n_m": 0.0, 
+                }
+                initial_guess.update(params)
+                initial_guess["log10_v_micro"] = approximate_log10_microturbulence(initial_guess["logg"])
 
-            yield (spectrum, initial_guess)
\ No newline at end of file
+                yield (spectrum, initial_guess)
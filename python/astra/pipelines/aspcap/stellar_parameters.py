@@ -1,5 +1,4 @@
 import os
-import numpy as np
 from typing import Iterable, Optional
 from peewee import fn
 from tqdm import tqdm
@@ -12,7 +11,7 @@ from astra.pipelines.ferre.pre_process import pre_process_ferre
 from astra.pipelines.ferre.post_process import post_process_ferre
 from astra.pipelines.ferre.utils import (
     parse_header_path, get_input_spectrum_primary_keys, read_control_file, read_file_with_name_and_data, read_ferre_headers,
-    format_ferre_input_parameters, format_ferre_control_keywords,
+    format_ferre_input_parameters, format_ferre_control_keywords, materialize_ferre_pixel_files,
 )
 from astra.pipelines.aspcap.utils import get_input_nml_paths, sanitise_parent_dir
 from astra.pipelines.aspcap.continuum import MedianFilter
@@ -100,19 +99,30 @@ def pre_stellar_parameters(
 
 
 @task
-def post_stellar_parameters(parent_dir, **kwargs) -> Iterable[FerreStellarParameters]:
+def post_stellar_parameters(parent_dir, materialize_pixel_files=False, **kwargs) -> Iterable[FerreStellarParameters]:
     """
     Collect the results from FERRE and create database entries for the stellar parameter step.
 
     :param parent_dir:
         The parent directory where these FERRE executions were planned.
+    
+    :param materialize_pixel_files: [optional]
+        Convert the FERRE pixel files to binary sidecar files after post-processing, so that
+        the next stage can memory-map them instead of parsing text. This roughly doubles the
+        disk space used by each working directory.
     """
     
-    for pwd in map(os.path.dirname, get_input_nml_paths(parent_dir, STAGE)):
+    pwds = list(map(os.path.dirname, get_input_nml_paths(parent_dir, STAGE)))
+    for pwd in pwds:
         log.info("Post-processing FERRE results in {0}".format(pwd))
         for i, kwds in enumerate(post_process_ferre(pwd)):
             yield FerreStellarParameters(**kwds)
 
+    if materialize_pixel_files:
+        # Post-processing re-writes the pixel files, so convert them to binary sidecars now for 
+        # the next stage to read.
+        materialize_ferre_pixel_files(pwds)
+
 
 
 def _pre_compute_continuum(coarse_result, spectrum, pre_continuum):
@@ -124,6 +134,13 @@ def _pre_compute_continuum(coarse_result, spectrum, pre_continuum):
         return (spectrum.spectrum_pk, None)
     else:
         return (spectrum.spectrum_pk, pre_computed_continuum)
+
+
+def _penalized_rchi2_sort_key(result):
+    # Sort NaNs last, as `np.argsort` would.
+    v = result.penalized_rchi2
+    return (v != v, v)
+
     
 def plan_stellar_parameters(
     spectra: Iterable[Spectrum],
@@ -204,14 +221,14 @@ def plan_stellar_parameters(
     n_spectra_with_equally_good_results = 0
     for spectrum_pk, coarse_results in coarse_results_dict.items():
         # TODO: Should we do anything other than getting the minimum penalized rchi2?
-        penalized_rchi2 = np.array([r.penalized_rchi2 for r in coarse_results])
-        indices = np.argsort(penalized_rchi2)
+        # There are only a handful of results per spectrum, so sort them directly instead of via an array.
+        ranked = sorted(coarse_results, key=_penalized_rchi2_sort_key)
 
-        if len(indices) > 1 and (penalized_rchi2[indices[0]] == penalized_rchi2[indices[1]]):
-            #log.warning(f"Multiple results for spectrum {spectrum_pk}: {penalized_rchi2[indices]}")
+        if len(ranked) > 1 and (ranked[0].penalized_rchi2 == ranked[1].penalized_rchi2):
+            #log.warning(f"Multiple results for spectrum {spectrum_pk}: {[r.penalized_rchi2 for r in ranked]}")
             n_spectra_with_equally_good_results += 1
 
-        coarse_results_dict[spectrum_pk] = coarse_results[indices[0]]
+        coarse_results_dict[spectrum_pk] = ranked[0]
 
     if n_spectra_with_equally_good_results:
         log.warning(f"There were {n_spectra_with_equally_good_results} spectra with multiple equally good results.")
@@ -10,7 +10,7 @@ from time import sleep, time
 from tqdm import tqdm
 from astra.utils import log, expand_path, flatten
 from astra.utils.slurm import SlurmJob, SlurmTask, get_queue
-from astra.pipelines.ferre.utils import parse_control_kwds, wc, read_ferre_headers, format_ferre_input_parameters, execute_ferre
+from astra.pipelines.ferre.utils import parse_control_kwds, wc, read_ferre_headers, format_ferre_input_parameters, execute_ferre, read_ferre_spectrum_names
 from shutil import copyfile
 from peewee import chunked
 
@@ -131,14 +131,13 @@ def partition_items(items, K, return_indices=False):
     else:
         itemizer = list(np.array(items)[sorter])
 
+    # Keep a running total per group rather than re-summing every group for each item.
+    totals = [0] * K
     while itemizer:
-        if return_indices:
-            group_index = np.argmin(
-                [sum([sizes[idx] for idx in group]) for group in groups]
-            )
-        else:
-            group_index = np.argmin(list(map(sum, groups)))
-        groups[group_index].append(itemizer.pop(-1))
+        group_index = np.argmin(totals)
+        item = itemizer.pop(-1)
+        groups[group_index].append(item)
+        totals[group_index] += sizes[item] if return_indices else item
 
     return [group for group in groups if len(group) > 0]
 
@@ -157,7 +156,7 @@ def post_execution_interpolation(pwd, n_threads=128, f_access=1, epsilon=0.001):
     headers = read_ferre_headers(synthfile)
 
     output_parameter_path = os.path.join(f"{pwd}/{os.path.basename(control_kwds['OPFILE'])}")
-    output_names = np.atleast_1d(np.loadtxt(output_parameter_path, usecols=(0, ), dtype=str))
+    output_names = read_ferre_spectrum_names(output_parameter_path)
     output_parameters = np.atleast_2d(np.loadtxt(output_parameter_path, usecols=range(1, 1 + int(control_kwds["NDIM"]))))
 
     clipped_parameters = np.clip(
@@ -1,12 +1,15 @@
 """Task for executing FERRE."""
 
 import os
+import json
+import hashlib
+import concurrent.futures
 import numpy as np
-from itertools import cycle
+from itertools import cycle, islice
 from typing import Optional, Iterable
 from astra.pipelines.ferre import utils
 from astra.models.spectrum import Spectrum
-from astra.utils import log, dict_to_list, expand_path
+from astra.utils import log, expand_path
 from tqdm import tqdm
 import warnings
 
@@ -55,6 +58,8 @@ def pre_process_ferre(
     spike_threshold_to_inflate_uncertainty: float = 3,
     reference_pixel_arrays_for_abundance_run=False,
     write_input_pixel_arrays=True,
+    max_workers: int = 16,
+    reuse_input_pixel_arrays: bool = False,
     **kwargs
 ):
     
@@ -105,89 +110,138 @@ def pre_process_ferre(
     # Construct mask to match FERRE model grid.
     #chip_wavelengths = tuple(map(utils.wavelength_array, segment_headers))
     
-    values_or_cycle_none = lambda x: x if (x is not None and len(x) > 0) else cycle([None])
-    all_initial_parameters = dict_to_list(dict(
-        teff=values_or_cycle_none(initial_teff),
-        logg=values_or_cycle_none(initial_logg),
-        m_h=values_or_cycle_none(initial_m_h),
-        log10_v_sini=values_or_cycle_none(initial_log10_v_sini),
-        log10_v_micro=values_or_cycle_none(initial_log10_v_micro),
-        alpha_m=values_or_cycle_none(initial_alpha_m),
-        c_m=values_or_cycle_none(initial_c_m),
-        n_m=values_or_cycle_none(initial_n_m),
-        initial_flags=values_or_cycle_none(initial_flags),
-        upstream_pk=values_or_cycle_none(upstream_pk)
-    ))
+    # Keep the initial parameters as one array per parameter, rather than a dict per spectrum.
+    # The stellar parameters are always included (even if they are all NaN) so that the
+    # array of initial parameters always has one row per spectrum.
+    given = lambda x: x is not None and len(x) > 0
+    all_initial_parameters = dict(
+        teff=initial_teff,
+        logg=initial_logg,
+        m_h=initial_m_h,
+        log10_v_sini=initial_log10_v_sini,
+        log10_v_micro=initial_log10_v_micro,
+        alpha_m=initial_alpha_m,
+        c_m=initial_c_m,
+        n_m=initial_n_m,
+    )
+    all_initial_parameters = {
+        k: np.asarray(v, dtype=float) for k, v in all_initial_parameters.items() 
+        if given(v) or k in ("teff", "logg", "m_h")
+    }
+    initial_flags = initial_flags if given(initial_flags) else cycle([None])
+    upstream_pk = upstream_pk if given(upstream_pk) else cycle([None])
 
     # Retrict to the pixels within the model wavelength grid.
     # TODO: Assuming all spectra are the same.
     #mask = _get_ferre_chip_mask(spectra[0].wavelength, chip_wavelengths)
 
     # TODO: use mask2
-    mask = utils.get_apogee_pixel_mask()
+    mask_indices = utils.get_apogee_pixel_indices()
     #assert np.all(mask == mask2)
 
-    index, skipped, batch_names, batch_initial_parameters, batch_flux, batch_e_flux = (0, [], [], [], [], [])
-    for (spectrum, initial_parameters) in tqdm(zip(spectra, all_initial_parameters), total=1, desc="Preparing spectra"):
-
-        if spectrum in skipped:
-            continue
-
-        if write_input_pixel_arrays:
-            # We usually will be writing input pixel arrays, but sometimes we won't
-            # (e.g., one other abundances execution has written the input pixel arrays
-            # and this one could just be referencing them)
-
-            # If this part fails, the spectrum doesn't exist and we should just continue
-            try:
-                flux = np.copy(spectrum.flux)
-                e_flux = np.copy(spectrum.ivar)**-0.5
-            except (ValueError, FileNotFoundError):
-                log.warning(f"Exception accessing pixel arrays for spectrum {spectrum}")
-                skipped.append(spectrum)
-                continue            
-
-            try:
-                pixel_flags = np.copy(spectrum.pixel_flags)
-            except AttributeError:
-                warnings.warn(f"At least one spectrum has no pixel_flags attribute")
-
-            else:
-                # TODO: move this to the ASPCAP coarse/stellar parameter section (before continuum norm).
-                flux, e_flux = inflate_errors_at_bad_pixels(
-                    flux,
-                    e_flux,
-                    pixel_flags,
-                    skyline_sigma_multiplier=skyline_sigma_multiplier,
-                    bad_pixel_flux_value=bad_pixel_flux_value,
-                    bad_pixel_error_value=bad_pixel_error_value,
-                    spike_threshold_to_inflate_uncertainty=spike_threshold_to_inflate_uncertainty,
-                    min_sigma_value=min_sigma_value,
-                )
-
-            if pre_computed_continuum is not None:
-                flux /= pre_computed_continuum[index]
-                e_flux /= pre_computed_continuum[index]
-            
-            batch_flux.append(flux[mask])
-            batch_e_flux.append(e_flux[mask])
-
-        # make the initial flags 0 if None is given
-        initial_flags = initial_parameters.pop("initial_flags") or 0
-        upstream_pk = initial_parameters.pop("upstream_pk")
+    # We need to know how many spectra there are to size the pixel arrays. The thread pool
+    # below would consume a generator up front anyway.
+    if not hasattr(spectra, "__len__"):
+        spectra = list(spectra)
 
-        batch_names.append(utils.get_ferre_spectrum_name(index, spectrum.source_pk, spectrum.spectrum_pk, initial_flags, upstream_pk))
-        batch_initial_parameters.append(initial_parameters)
-        index += 1
+    n_initial = min([v.size for v in all_initial_parameters.values() if v.ndim > 0] or [np.inf])
+    n_spectra = min(len(spectra), n_initial)
 
-    if not batch_initial_parameters:
+    if reference_pixel_arrays_for_abundance_run:
+        flux_path = os.path.join(absolute_pwd, "../", control_kwds["ffile"])
+        e_flux_path = os.path.join(absolute_pwd, "../", control_kwds["erfile"])
+    else:
+        flux_path = os.path.join(absolute_pwd, control_kwds["ffile"])
+        e_flux_path = os.path.join(absolute_pwd, control_kwds["erfile"])
+
+    # If we are re-running with the same inputs (e.g., after FERRE failed), the input pixel
+    # arrays on disk are still good, and we only need to know which spectra were skipped.
+    # This is opt-in: the key only covers the spectrum identifiers and settings, so it will not
+    # notice if a spectrum was re-reduced under the same identifier.
+    cached_skipped = input_pixel_arrays_key = None
+    record_path = os.path.join(os.path.dirname(flux_path), "input_pixel_arrays.json")
+    if write_input_pixel_arrays and reuse_input_pixel_arrays:
+        input_pixel_arrays_key = _get_input_pixel_arrays_key(
+            spectra,
+            n_spectra,
+            pre_computed_continuum,
+            n_pixels=mask_indices.size,
+            bad_pixel_flux_value=bad_pixel_flux_value,
+            bad_pixel_error_value=bad_pixel_error_value,
+            skyline_sigma_multiplier=skyline_sigma_multiplier,
+            min_sigma_value=min_sigma_value,
+            spike_threshold_to_inflate_uncertainty=spike_threshold_to_inflate_uncertainty,
+        )
+        cached_skipped = _read_input_pixel_arrays_record(record_path, input_pixel_arrays_key, flux_path, e_flux_path)
+        if cached_skipped is not None:
+            log.info(f"Re-using input pixel arrays in {os.path.dirname(flux_path)}")
+
+    # We usually will be writing input pixel arrays, but sometimes we won't
+    # (e.g., one other abundances execution has written the input pixel arrays
+    # and this one could just be referencing them)
+    load_pixel_arrays = write_input_pixel_arrays and cached_skipped is None
+    if load_pixel_arrays:
+        # Reading pixel arrays is mostly waiting on disk, so load them in threads.
+        # Results come back in the same order as the spectra.
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        # Only submit the spectra we will consider, so we don't wait on loads we won't use.
+        loaded = executor.map(_load_pixel_arrays, islice(spectra, n_spectra))
+    else:
+        executor = None
+        loaded = ((spectrum, None) for spectrum in spectra)
+
+    index, skipped, skipped_spectrum_pks, skipped_indices, batch_names, batch_indices = (0, [], set(), [], [], [])
+    batch_flux = batch_e_flux = batch_pixel_flags = has_pixel_flags = None
+    try:
+        for i, ((spectrum, pixel_arrays), spectrum_initial_flags, spectrum_upstream_pk) in enumerate(tqdm(zip(loaded, initial_flags, upstream_pk), total=n_spectra, desc="Preparing spectra", mininterval=1.0)):
+            if i >= n_initial:
+                break
+
+            # If loading failed, the spectrum doesn't exist and we should just continue
+            if (pixel_arrays is None) if load_pixel_arrays else (cached_skipped is not None and i in cached_skipped):
+                if spectrum.spectrum_pk not in skipped_spectrum_pks:
+                    skipped.append(spectrum)
+                    skipped_spectrum_pks.add(spectrum.spectrum_pk)
+                skipped_indices.append(i)
+                continue
+
+            if load_pixel_arrays:
+                # The pixel arrays are processed together once all spectra are gathered.
+                # Copy each spectrum into preallocated arrays, so the loaded arrays can be freed
+                # as we go, rather than stacking them all at the end.
+                flux, e_flux, pixel_flags = pixel_arrays
+                if batch_flux is None:
+                    batch_flux = np.empty((n_spectra, flux.size))
+                    batch_e_flux = np.empty((n_spectra, flux.size))
+                    batch_pixel_flags = np.zeros((n_spectra, flux.size), dtype=np.int64)
+                    has_pixel_flags = np.zeros(n_spectra, dtype=bool)
+
+                batch_flux[index] = flux
+                batch_e_flux[index] = e_flux
+                if pixel_flags is not None:
+                    batch_pixel_flags[index] = pixel_flags
+                    has_pixel_flags[index] = True
+
+            # make the initial flags 0 if None is given
+            batch_names.append(utils.get_ferre_spectrum_name(index, spectrum.source_pk, spectrum.spectrum_pk, spectrum_initial_flags or 0, spectrum_upstream_pk))
+            batch_indices.append(i)
+            index += 1
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    if not batch_indices:
         return (pwd, 0, skipped)
 
     control_kwds_formatted = utils.format_ferre_control_keywords(control_kwds, n_obj=1 + index)
     log.info(f"FERRE control keywords:\n{control_kwds_formatted}")
 
-    # Convert list of dicts of initial parameters to array.
+    # Convert the initial parameters of the spectra we kept to an array.
     log.info(f"Validating initial and frozen parameters")
+    batch_initial_parameters = {
+        k: (np.repeat(v, len(batch_indices)) if v.ndim == 0 else v[batch_indices])
+        for k, v in all_initial_parameters.items()
+    }
     batch_initial_parameters_array = utils.validate_initial_and_frozen_parameters(
         headers,
         batch_initial_parameters,
@@ -197,51 +251,198 @@ def pre_process_ferre(
     )
     # Create directory and write the control file        
     os.makedirs(absolute_pwd, exist_ok=True)
+
+    # None of the output files depend on each other, so write them in threads. This lets the
+    # writes overlap with each other (and with processing the pixel arrays) on slow file systems.
+    writer = concurrent.futures.ThreadPoolExecutor(max_workers=3)
     log.info(f"Writing control file")
-    with open(os.path.join(absolute_pwd, "input.nml"), "w") as fp:
-        fp.write(control_kwds_formatted)       
+    writes = [writer.submit(_write_text, os.path.join(absolute_pwd, "input.nml"), control_kwds_formatted)]
 
     # hack: we do basename here in case we wrote the prefix to PFILE for the abundances run
     log.info(f"Writing input parameters")
-    with open(os.path.join(absolute_pwd, os.path.basename(control_kwds["pfile"])), "w") as fp:
-        for name, point in zip(batch_names, batch_initial_parameters_array):
-            fp.write(utils.format_ferre_input_parameters(*point, name=name))
+    writes.append(
+        writer.submit(
+            utils.write_ferre_input_parameters,
+            os.path.join(absolute_pwd, os.path.basename(control_kwds["pfile"])),
+            batch_names,
+            batch_initial_parameters_array
+        )
+    )
 
-    if write_input_pixel_arrays:
+    if load_pixel_arrays:
         log.info(f"Writing input pixel arrays")
         LARGE = 1e10
 
-        batch_flux = np.array(batch_flux)
-        batch_e_flux = np.array(batch_e_flux)
-
-        if reference_pixel_arrays_for_abundance_run:
-            flux_path = os.path.join(absolute_pwd, "../", control_kwds["ffile"])
-            e_flux_path = os.path.join(absolute_pwd, "../", control_kwds["erfile"])
-        else:
-            flux_path = os.path.join(absolute_pwd, control_kwds["ffile"])
-            e_flux_path = os.path.join(absolute_pwd, control_kwds["erfile"])
+        batch_flux = batch_flux[:index]
+        batch_e_flux = batch_e_flux[:index]
+        batch_pixel_flags = batch_pixel_flags[:index]
+        has_pixel_flags = has_pixel_flags[:index]
+
+        # Inflate errors for all spectra with pixel flags at once.
+        # TODO: move this to the ASPCAP coarse/stellar parameter section (before continuum norm).
+        if np.any(has_pixel_flags):
+            flagged_flux = batch_flux[has_pixel_flags]
+            flagged_e_flux = batch_e_flux[has_pixel_flags]
+            flagged_pixel_flags = batch_pixel_flags[has_pixel_flags]
+
+            # Each spectrum is inflated independently, and in place, so blocks of rows can be
+            # done in threads (NumPy releases the GIL) without copying them to other processes.
+            def inflate_rows(si):
+                rows = slice(si, si + block_size)
+                inflate_errors_at_bad_pixels(
+                    flagged_flux[rows],
+                    flagged_e_flux[rows],
+                    flagged_pixel_flags[rows],
+                    skyline_sigma_multiplier=skyline_sigma_multiplier,
+                    bad_pixel_flux_value=bad_pixel_flux_value,
+                    bad_pixel_error_value=bad_pixel_error_value,
+                    spike_threshold_to_inflate_uncertainty=spike_threshold_to_inflate_uncertainty,
+                    min_sigma_value=min_sigma_value,
+                )
 
-        non_finite_flux = ~np.isfinite(batch_flux)
-        batch_flux[non_finite_flux] = 0.0
-        batch_e_flux[non_finite_flux] = LARGE
-        if np.any(non_finite_flux):
+            block_size = 64
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for _ in executor.map(inflate_rows, range(0, len(flagged_flux), block_size)):
+                    None
+
+            batch_flux[has_pixel_flags] = flagged_flux
+            batch_e_flux[has_pixel_flags] = flagged_e_flux
+
+        if pre_computed_continuum is not None:
+            # Take the reciprocal once and multiply both arrays, which is cheaper than dividing twice.
+            inverse_continuum = np.array(pre_computed_continuum[:len(batch_flux)], dtype=float)
+            np.reciprocal(inverse_continuum, out=inverse_continuum)
+            batch_flux *= inverse_continuum
+            batch_e_flux *= inverse_continuum
+
+        # FERRE only reads 4 significant figures, so single precision is plenty for the
+        # masked arrays that are cleaned and written out.
+        masked_shape = (batch_flux.shape[0], mask_indices.size)
+        batch_flux = np.take(batch_flux, mask_indices, axis=1, out=np.empty(masked_shape, dtype=np.float32))
+        batch_e_flux = np.take(batch_e_flux, mask_indices, axis=1, out=np.empty(masked_shape, dtype=np.float32))
+
+        # Re-use one boolean buffer for both checks, and only write when something is wrong.
+        # We can't rely on the bad pixel mask from `inflate_errors_at_bad_pixels` instead of
+        # scanning here: not every spectrum has pixel flags, dividing by the continuum can
+        # introduce non-finite values, and very large errors overflow when cast to float32.
+        non_finite = np.isfinite(batch_flux)
+        np.logical_not(non_finite, out=non_finite)
+        if np.any(non_finite):
+            np.copyto(batch_flux, 0.0, where=non_finite)
+            np.copyto(batch_e_flux, LARGE, where=non_finite)
             log.warning(f"Non-finite fluxes found. Setting them to zero and setting flux error to {LARGE:.1e}")
 
-        finite_e_flux = np.isfinite(batch_e_flux)
-        batch_e_flux[~finite_e_flux] = LARGE
-        if not np.any(finite_e_flux):
-            log.warning(f"ALL flux errors are non-finite!")
+        np.isfinite(batch_e_flux, out=non_finite)
+        np.logical_not(non_finite, out=non_finite)
+        if np.any(non_finite):
+            if np.all(non_finite):
+                log.warning(f"ALL flux errors are non-finite!")
+            np.copyto(batch_e_flux, LARGE, where=non_finite)
             
         # Write data arrays.
-        savetxt_kwds = dict(fmt="%.4e")#footer="\n")
-        np.savetxt(flux_path, batch_flux, **savetxt_kwds)
-        np.savetxt(e_flux_path, batch_e_flux, **savetxt_kwds)
+        writes.append(writer.submit(utils.write_ferre_pixel_file, flux_path, batch_flux))
+        writes.append(writer.submit(utils.write_ferre_pixel_file, e_flux_path, batch_e_flux))
+
+    writer.shutdown()
+    for write in writes:
+        # Raise any exception from writing.
+        write.result()
+
+    if load_pixel_arrays and input_pixel_arrays_key is not None:
+        # Only record the inputs once the pixel arrays are safely written.
+        _write_input_pixel_arrays_record(record_path, input_pixel_arrays_key, skipped_indices)
         
     n_obj = len(batch_names)
     return (pwd, n_obj, skipped)
 
 
 
+def _get_input_pixel_arrays_key(spectra, n_spectra, pre_computed_continuum, **kwargs):
+    """
+    Return a hash of everything that determines the contents of the input pixel arrays.
+
+    :param spectra:
+        The spectra to process.
+
+    :param n_spectra:
+        The number of spectra that will be considered.
+
+    :param pre_computed_continuum:
+        The pre-computed continuum for each spectrum, or `None`.
+
+    :param kwargs:
+        Any other (JSON-serializable) settings that affect the pixel arrays.
+    """
+    key = hashlib.sha1()
+    key.update(json.dumps([spectrum.spectrum_pk for spectrum in islice(spectra, n_spectra)]).encode())
+    key.update(json.dumps(kwargs, sort_keys=True, default=str).encode())
+    if pre_computed_continuum is not None:
+        for continuum in pre_computed_continuum[:n_spectra]:
+            key.update(np.ascontiguousarray(continuum, dtype=float).tobytes())
+    return key.hexdigest()
+
+
+def _read_input_pixel_arrays_record(path, key, *pixel_paths):
+    """
+    Return the indices of the spectra skipped when the input pixel arrays were written, or
+    `None` if the record does not match `key`, or the pixel arrays were written after it.
+    """
+    try:
+        with open(path, "r") as fp:
+            record = json.load(fp)
+        record_mtime = os.path.getmtime(path)
+        if record["key"] != key or any(os.path.getmtime(p) > record_mtime for p in pixel_paths):
+            return None
+        return set(record["skipped"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _write_input_pixel_arrays_record(path, key, skipped_indices):
+    # Write to a temporary file and move it into place, so a partial record is never read.
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as fp:
+        json.dump(dict(key=key, skipped=skipped_indices), fp)
+    os.replace(temp_path, path)
+
+
+def _write_text(path, contents):
+    with open(path, "w") as fp:
+        fp.write(contents)
+
+
+def _load_pixel_arrays(spectrum):
+    """
+    Load the flux, flux error, and pixel flags for a spectrum.
+
+    :param spectrum:
+        The spectrum to load.
+
+    :returns:
+        A two-length tuple of the spectrum and its `(flux, e_flux, pixel_flags)` arrays.
+        The arrays are `None` if the spectrum could not be loaded, and `pixel_flags` is
+        `None` if the spectrum has no pixel flags.
+    """
+    try:
+        flux = np.array(spectrum.flux, dtype=float)
+        # e_flux = ivar**-0.5, but sqrt and reciprocal are much cheaper than a fractional power,
+        # and taking the sqrt straight from ivar means we allocate once without a separate copy.
+        # Zero or negative ivar gives inf or NaN, which are treated as bad pixels later.
+        e_flux = np.sqrt(spectrum.ivar, dtype=float)
+        np.reciprocal(e_flux, out=e_flux)
+    except (ValueError, FileNotFoundError):
+        log.warning(f"Exception accessing pixel arrays for spectrum {spectrum}")
+        return (spectrum, None)
+
+    try:
+        pixel_flags = np.copy(spectrum.pixel_flags)
+    except AttributeError:
+        warnings.warn(f"At least one spectrum has no pixel_flags attribute")
+        pixel_flags = None
+
+    return (spectrum, (flux, e_flux, pixel_flags))
+
+
 def inflate_errors_at_bad_pixels(
     flux,
     e_flux,
@@ -252,19 +453,29 @@ def inflate_errors_at_bad_pixels(
     spike_threshold_to_inflate_uncertainty,
     min_sigma_value,
 ):
+    """
+    Inflate the flux errors at skylines, spikes, and bad pixels.
+
+    The arrays can be for a single spectrum, with shape `(P, )`, or for many spectra, with
+    shape `(N, P)`. The median and standard deviation used to find spikes are computed
+    separately for each spectrum. The `flux` and `e_flux` arrays are modified in place.
+    """
+    # Test the skyline and bad pixel bits in one pass over the bitfield.
+    flagged = np.bitwise_and(bitfield, 4096 | 16639)
+
     # Inflate errors around skylines,
-    skyline_mask = (bitfield & 4096) > 0 # significant skyline
-    e_flux[skyline_mask] *= skyline_sigma_multiplier
+    skyline_mask = (flagged & 4096) > 0 # significant skyline
+    np.multiply(e_flux, skyline_sigma_multiplier, out=e_flux, where=skyline_mask)
 
     # Sometimes FERRE will run forever.
     if spike_threshold_to_inflate_uncertainty > 0:
 
-        flux_median = np.nanmedian(flux)
-        flux_stddev = np.nanstd(flux)
-        e_flux_median = np.median(e_flux)
-
-        delta = (flux - flux_median) / flux_stddev
-        is_spike = (delta > spike_threshold_to_inflate_uncertainty)
+        # For a positive threshold, (flux - median) / stddev > threshold is the same test as
+        # flux > median + threshold * stddev, which compares against one value per spectrum
+        # instead of building a full array of deltas.
+        spike_limit = np.nanmedian(flux, axis=-1, keepdims=True)
+        spike_limit += spike_threshold_to_inflate_uncertainty * np.nanstd(flux, axis=-1, keepdims=True)
+        is_spike = np.greater(flux, spike_limit, out=skyline_mask)
         #* (
         #    sigma_ < (parameters["spike_threshold_to_inflate_uncertainty"] * e_flux_median)
         #)
@@ -282,28 +493,42 @@ def inflate_errors_at_bad_pixels(
 
     # Set bad pixels to have no useful data.
     if bad_pixel_flux_value is not None or bad_pixel_error_value is not None:                            
-        bad = (
-            ~np.isfinite(flux)
-            | ~np.isfinite(e_flux)
-            | (flux < 0)
-            | (e_flux < 0)
-            | ((bitfield & 16639) > 0) # any bad value (level = 1)
-        )
+        # Accumulate into one mask (with one scratch) instead of five temporaries.
+        bad = np.empty(flux.shape, dtype=bool)
+        scratch = skyline_mask
+        np.isfinite(flux, out=bad)
+        np.logical_not(bad, out=bad)
+        np.isfinite(e_flux, out=scratch)
+        np.logical_not(scratch, out=scratch)
+        np.logical_or(bad, scratch, out=bad)
+        np.less(flux, 0, out=scratch)
+        np.logical_or(bad, scratch, out=bad)
+        np.less(e_flux, 0, out=scratch)
+        np.logical_or(bad, scratch, out=bad)
+        np.bitwise_and(flagged, 16639, out=flagged) # any bad value (level = 1)
+        np.logical_or(bad, flagged, out=bad)
 
         flux[bad] = bad_pixel_flux_value
         e_flux[bad] = bad_pixel_error_value        
 
     if min_sigma_value is not None:
-        e_flux = np.clip(e_flux, min_sigma_value, np.inf)
+        np.clip(e_flux, min_sigma_value, None, out=e_flux)
 
     return (flux, e_flux)
 
 
 def _get_ferre_chip_mask(observed_wavelength, chip_wavelengths):
+    """
+    Return a mask of the observed pixels that fall on the FERRE model chips.
+
+    This is the general form, for any observed wavelength array and model grid. For the
+    standard APOGEE grid, use `utils.get_apogee_pixel_mask` or `utils.get_apogee_pixel_indices`,
+    which are computed once per process.
+    """
     P = observed_wavelength.size
     mask = np.zeros(P, dtype=bool)
-    for model_wavelength in chip_wavelengths:
-        s_index = observed_wavelength.searchsorted(model_wavelength[0])
-        e_index = s_index + model_wavelength.size
-        mask[s_index:e_index] = True
+    # Search for the start of all chips at once.
+    s_indices = observed_wavelength.searchsorted([model_wavelength[0] for model_wavelength in chip_wavelengths])
+    for s_index, model_wavelength in zip(s_indices, chip_wavelengths):
+        mask[s_index:s_index + model_wavelength.size] = True
     return mask                    
\ No newline at end of file
@@ -1,14 +1,17 @@
 """General FERRE utilities."""
 
 import os
+import json
 import datetime
 import numpy as np
 import re
 import subprocess
+import concurrent.futures
 from typing import Optional
 from tqdm import tqdm
 from glob import glob
 from itertools import cycle
+from functools import lru_cache
 from astra.utils import log, expand_path
 
 
@@ -23,6 +26,38 @@ TRANSLATE_LABELS = {
     "n_m": "N",
 }
 
+# The data type used to store FERRE pixel arrays in binary sidecar files. A 16-bit float halves
+# the storage and bandwidth, but it overflows for the large uncertainties we give to bad pixels
+# in `e_flux.input`, and it is not precise enough for high S/N spectra.
+FERRE_PIXEL_DTYPE = np.float32
+
+# The FERRE pixel files read by `astra.models.ferre.FerreOutputMixin`, and whether their first
+# column is the spectrum name.
+FERRE_PIXEL_FILES = (
+    ("flux.input", False),
+    ("e_flux.input", False),
+    ("model_flux.output", True),
+    ("rectified_model_flux.output", True),
+    ("rectified_flux.output", True),
+)
+
+def read_ferre_spectrum_names(path):
+    """
+    Read the spectrum names from the first column of a FERRE file.
+
+    This only splits off the first field of each line, which is much faster than using 
+    `np.loadtxt` on files with thousands of columns.
+
+    :param path:
+        The path of the FERRE file.
+    
+    :returns:
+        A one-dimensional array of spectrum names.
+    """
+    with open(path, "r") as fp:
+        return np.array([fields[0] for fields in (line.split(maxsplit=1) for line in fp) if fields], dtype=str)
+
+
 def get_input_spectrum_primary_keys(stage_dir):
     """
     Get all spectrum identifiers analyzed in a given stage.
@@ -32,7 +67,7 @@ def get_input_spectrum_primary_keys(stage_dir):
     """
     spectrum_pks = set()
     for path in glob(f"{expand_path(stage_dir)}/*/parameter.input"):
-        for name in np.atleast_1d(np.loadtxt(path, usecols=(0, ), dtype=str)):
+        for name in read_ferre_spectrum_names(path):
             spectrum_pks.add(parse_ferre_spectrum_name(name)["spectrum_pk"])
     return spectrum_pks
 
@@ -101,14 +136,30 @@ def get_apogee_segment_indices():
     start_indices = np.round((segment_log10_wl_start - 4.179) / 6e-6).astype(int)
     return (start_indices, segment_pixels)
 
+@lru_cache(maxsize=None)
 def get_apogee_pixel_mask():
     # TODO: put elsewhere?
+    # This is computed once per process, and it is read-only because every caller shares it.
     mask = np.zeros(8575, dtype=bool)
     for si, p in zip(*get_apogee_segment_indices()):
         mask[si:si+p] = True
     assert mask.sum() == 7514
+    mask.flags.writeable = False
     return mask
 
+
+@lru_cache(maxsize=None)
+def get_apogee_pixel_indices():
+    """
+    Return the (read-only) indices of the pixels selected by `get_apogee_pixel_mask`.
+
+    Taking these indices along the pixel axis of a batch of spectra is a single gather,
+    rather than a scan of the boolean mask.
+    """
+    indices = np.flatnonzero(get_apogee_pixel_mask())
+    indices.flags.writeable = False
+    return indices
+
 '''
 def mask_apogee_pixel_array(pixel_array):
     pixel_array = np.atleast_2d(pixel_array)
@@ -160,6 +211,278 @@ def parse_ferre_spectrum_name(name):
     )
 
 
+def _parse_ferre_pixel_line(line, P, has_names, dtype):
+    name = None
+    if has_names:
+        name, line = line.split(maxsplit=1)
+    # `np.fromstring` parses straight to the floats we need, unlike `np.loadtxt`.
+    return (name, np.fromstring(line, dtype=dtype, sep=" ", count=P))
+
+
+def _parse_ferre_pixel_file(path, P, has_names, dtype):
+    try:
+        import pandas as pd
+    except ImportError:
+        names, rows = ([], [])
+        with open(path, "r") as fp:
+            for line in fp:
+                if line.strip():
+                    name, row = _parse_ferre_pixel_line(line, P, has_names, dtype)
+                    names.append(name)
+                    rows.append(row)
+        data = np.vstack(rows) if rows else np.empty((0, P), dtype=dtype)
+        return (np.array(names, dtype=str) if has_names else None, data)
+
+    offset = int(has_names)
+    df = pd.read_csv(
+        path, 
+        sep=r"\s+", 
+        header=None, 
+        engine="c", 
+        usecols=range(offset + P),
+        dtype={0: str} if has_names else np.float32
+    )
+    names = df[0].to_numpy(dtype=str) if has_names else None
+    data = df.iloc[:, offset:].to_numpy(dtype=dtype)
+    return (names, data)
+
+
+def _save_ferre_pixel_sidecar(path, array):
+    # Write to a temporary file and move it into place, so that concurrent readers never see a
+    # partially written array.
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as fp:
+            np.save(fp, array)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+
+def _get_ferre_pixel_sidecar_paths(path, has_names):
+    return (f"{path}.npy", f"{path}.names.npy" if has_names else None, f"{path}.npy.json")
+
+
+def _has_current_ferre_pixel_sidecars(path, P, has_names, dtype):
+    # The sidecars are current if they were made from a file with the same modification time
+    # and size as `path` has now, and they have the expected shape and data type.
+    data_path, names_path, meta_path = _get_ferre_pixel_sidecar_paths(path, has_names)
+    try:
+        stat = os.stat(path)
+        with open(meta_path, "r") as fp:
+            meta = json.load(fp)
+        if (
+            meta["st_mtime_ns"] != stat.st_mtime_ns
+        or  meta["st_size"] != stat.st_size
+        or  (names_path is not None and not os.path.exists(names_path))
+        ):
+            return False
+        # This only reads the header of the array.
+        existing = np.load(data_path, mmap_mode="r")
+        return (existing.dtype == dtype and existing.shape == (meta["N"], P))
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+
+def materialize_ferre_pixel_file(path, P=7514, has_names=True, dtype=None):
+    """
+    Convert a FERRE pixel file to binary `.npy` sidecar files, if they do not exist already.
+
+    The pixel data are stored in `{path}.npy` as a `(N, P)` array, and the spectrum names (if 
+    any) are stored in `{path}.names.npy`. The modification time (in nanoseconds) and size of
+    the text file are stored in `{path}.npy.json`, and existing sidecars are only re-used if 
+    those still match the text file, and the array has the expected shape and data type.
+
+    :param path:
+        The path of the FERRE pixel file.
+    
+    :param P: [optional]
+        The number of pixels per row.
+    
+    :param has_names: [optional]
+        Whether the first column of the file is the spectrum name.
+    
+    :param dtype: [optional]
+        The data type to store the pixel data as. Defaults to `FERRE_PIXEL_DTYPE`.
+    
+    :returns:
+        A two-length tuple of the `(data, names)` sidecar paths, where the names path is `None`
+        if the file has no name column.
+    """
+    path = expand_path(path)
+    dtype = np.dtype(dtype or FERRE_PIXEL_DTYPE)
+    data_path, names_path, meta_path = _get_ferre_pixel_sidecar_paths(path, has_names)
+    if not _has_current_ferre_pixel_sidecars(path, P, has_names, dtype):
+        # Take the file status before parsing, so that if the file is re-written while we parse
+        # it, the sidecars will be considered stale.
+        stat = os.stat(path)
+        names, data = _parse_ferre_pixel_file(path, P, has_names, dtype)
+        # Write the metadata last, so that its existence implies the other sidecars are complete.
+        if has_names:
+            _save_ferre_pixel_sidecar(names_path, names)
+        _save_ferre_pixel_sidecar(data_path, data)
+        meta = dict(st_mtime_ns=stat.st_mtime_ns, st_size=stat.st_size, N=data.shape[0])
+        temp_path = f"{meta_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "w") as fp:
+                json.dump(meta, fp)
+            os.replace(temp_path, meta_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+    return (data_path, names_path)
+
+
+def materialize_ferre_pixel_files(pwds, max_workers=None):
+    """
+    Convert the FERRE pixel files in many working directories to binary sidecar files, in parallel.
+
+    Each file is converted in a separate process with `materialize_ferre_pixel_file`. Files that
+    do not exist are skipped, and files that fail to convert are logged and will be parsed from
+    text when they are next read.
+
+    :param pwds:
+        An iterable of FERRE working directories.
+    
+    :param max_workers: [optional]
+        The maximum number of processes to use.
+    """
+    paths = []
+    for pwd in pwds:
+        for basename, has_names in FERRE_PIXEL_FILES:
+            path = expand_path(f"{pwd}/{basename}")
+            if os.path.exists(path):
+                paths.append((path, has_names))
+    
+    if not paths:
+        return None
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        futures = { 
+            executor.submit(materialize_ferre_pixel_file, path, has_names=has_names): path 
+            for path, has_names in paths 
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                log.exception(f"Exception when materializing {futures[future]}")
+    return None
+
+
+def read_ferre_pixel_file(path, P=7514, has_names=True, dtype=None):
+    """
+    Read all rows of a FERRE pixel file (e.g., `flux.input`, `model_flux.output`).
+
+    If the file has current binary sidecar files (see `materialize_ferre_pixel_file`), those
+    are memory-mapped. Otherwise the text file is parsed; sidecars are never written here.
+
+    Results are cached in memory by the resolved path, modification time, and size of the file,
+    so a file that is re-written (e.g., by re-running FERRE) is read again.
+
+    :param path:
+        The path of the FERRE pixel file.
+    
+    :param P: [optional]
+        The number of pixels per row.
+    
+    :param has_names: [optional]
+        Whether the first column of the file is the spectrum name. This is true for output
+        files, and false for input files.
+    
+    :param dtype: [optional]
+        The data type of the pixel data. Defaults to `FERRE_PIXEL_DTYPE`.
+    
+    :returns:
+        A two-length tuple of `(names, data)`, where `names` is `None` if the file has no
+        name column, and `data` is a read-only `(N, P)` array.
+    """
+    # Resolve the path so that all results sharing a file (e.g., the `../flux.input` of every
+    # abundance directory) share one cache entry and one memory map.
+    path = os.path.realpath(expand_path(path))
+    stat = os.stat(path)
+    return _read_ferre_pixel_file(path, stat.st_mtime_ns, stat.st_size, P, has_names, dtype)
+
+
+@lru_cache(maxsize=32)
+def _read_ferre_pixel_file(path, mtime_ns, size, P, has_names, dtype):
+    # The modification time and size are only used as part of the cache key.
+    dtype = np.dtype(dtype or FERRE_PIXEL_DTYPE)
+    if _has_current_ferre_pixel_sidecars(path, P, has_names, dtype):
+        data_path, names_path, _ = _get_ferre_pixel_sidecar_paths(path, has_names)
+        try:
+            data = np.load(data_path, mmap_mode="r")
+            names = np.load(names_path) if has_names else None
+        except (OSError, ValueError):
+            pass
+        else:
+            return (names, data)
+
+    names, data = _parse_ferre_pixel_file(path, P, has_names, dtype)
+    data.flags.writeable = False
+    return (names, data)
+
+
+def write_ferre_pixel_file(path, array, fmt="%.4e", buffering=1 << 20, block_size=256):
+    """
+    Write a FERRE input pixel file (e.g., `flux.input`), with one row per spectrum.
+
+    This writes the same text as `np.savetxt(path, array, fmt=fmt)`, but it formats each row
+    with a single pre-built template, and it writes through a large buffer so that many rows
+    go out in each system call.
+
+    :param path:
+        The path to write to.
+
+    :param array:
+        A two-dimensional `(N, P)` array of pixel values.
+
+    :param fmt: [optional]
+        The format for each pixel value.
+
+    :param buffering: [optional]
+        The size of the write buffer, in bytes.
+
+    :param block_size: [optional]
+        The number of rows to convert to Python floats at a time.
+    """
+    array = np.atleast_2d(array)
+    template = " ".join([fmt] * array.shape[1]) + "\n"
+    with open(path, "w", buffering=buffering) as fp:
+        # Formatting Python floats is faster than formatting NumPy scalars, but a list of Python
+        # floats takes many times the memory of the array, so convert a block of rows at a time.
+        for si in range(0, array.shape[0], block_size):
+            for row in array[si:si + block_size].tolist():
+                fp.write(template % tuple(row))
+
+
+def write_ferre_input_parameters(path, names, points, buffering=1 << 20):
+    """
+    Write a FERRE input parameter file (e.g., `parameter.input`), with one row per spectrum.
+
+    This writes the same text as calling `format_ferre_input_parameters` for every row, but it
+    formats each row with a single pre-built template and writes the file in one call.
+
+    :param path:
+        The path to write to.
+
+    :param names:
+        The FERRE spectrum names, one per row.
+
+    :param points:
+        A two-dimensional `(N, L)` array of input parameters.
+
+    :param buffering: [optional]
+        The size of the write buffer, in bytes.
+    """
+    points = np.atleast_2d(points)
+    template = "%-40s" + "%12.3f" * points.shape[1] + "\n"
+    contents = "".join([template % (name, *point) for name, point in zip(names, points.tolist())])
+    with open(path, "w", buffering=buffering) as fp:
+        fp.write(contents)
+
+
 def get_ferre_label_name(parameter_name, ferre_label_names, transforms=None):
     transforms = transforms or TRANSLATE_LABELS
 
@@ -834,7 +1157,28 @@ def validate_initial_and_frozen_parameters(
     clip_epsilon_percent=1,
 ):
 
-    N = len(initial_parameters)
+    """
+    Build the array of initial parameters for FERRE, with frozen parameters applied.
+
+    :param headers:
+        The FERRE grid headers.
+
+    :param initial_parameters:
+        Either a list of dictionaries (one per spectrum) of initial parameters, or a
+        dictionary that maps each parameter name to a sequence with one value per spectrum.
+        Non-finite values are replaced by the grid mid-point.
+
+    :param frozen_parameters:
+        A dictionary of parameter names and the values to freeze them at.
+
+    :returns:
+        A `(N, L)` array of initial parameters, ordered by the grid labels.
+    """
+    columnar = isinstance(initial_parameters, dict)
+    if columnar:
+        N = len(next(iter(initial_parameters.values()), ()))
+    else:
+        N = len(initial_parameters)
     
     ferre_label_names = headers["LABEL"]
 
@@ -842,29 +1186,35 @@ def validate_initial_and_frozen_parameters(
     initial_parameters_array = np.tile(mid_point, N).reshape((N, -1))
     warning_messages = []
 
-    for i, ip in enumerate(initial_parameters):
-        for parameter_name, value in ip.items():
+    def get_label_index(parameter_name):
+        try:
+            ferre_label_name = get_ferre_label_name(parameter_name, ferre_label_names, transforms)
+        except:
+            message = f"Ignoring initial parameter '{parameter_name}' as it is not in {ferre_label_names}"
+        else:
+            if ferre_label_name in ferre_label_names:
+                return ferre_label_names.index(ferre_label_name)
+            message = f"Ignoring initial parameter '{ferre_label_name}' as it is not in {ferre_label_names}"
+
+        if message not in warning_messages:
+            log.warning(message)
+            warning_messages.append(message)
+        return None
 
-            try:
-                ferre_label_name = get_ferre_label_name(parameter_name, ferre_label_names, transforms)
-            except:
-                message = f"Ignoring initial parameter '{parameter_name}' as it is not in {ferre_label_names}"
-                if message not in warning_messages:
-                    log.warning(message)
-                    warning_messages.append(message)
+    if columnar:
+        for parameter_name, values in initial_parameters.items():
+            j = get_label_index(parameter_name)
+            if j is None:
                 continue
-        
-            else:
-                if ferre_label_name not in ferre_label_names:
-                    message = f"Ignoring initial parameter '{ferre_label_name}' as it is not in {ferre_label_names}"
-                    if message not in warning_messages:
-                        log.warning(message)
-                        warning_messages.append(message)
-                    continue
-
-            if np.isfinite(value):
-                j = ferre_label_names.index(ferre_label_name)
-                initial_parameters_array[i, j] = value
+            values = np.asarray(values, dtype=float)
+            finite = np.isfinite(values)
+            initial_parameters_array[finite, j] = values[finite]
+    else:
+        for i, ip in enumerate(initial_parameters):
+            for parameter_name, value in ip.items():
+                j = get_label_index(parameter_name)
+                if j is not None and np.isfinite(value):
+                    initial_parameters_array[i, j] = value
 
     # Update with frozen parameters
     for parameter_name, value in frozen_parameters.items():
@@ -1154,7 +1504,7 @@ def check_ferre_progress(
 
 
 def read_and_sort_output_data_file(path, input_names, n_data_columns=None, dtype=float):
-    names = np.atleast_1d(np.loadtxt(path, usecols=(0, ), dtype=str))
+    names = read_ferre_spectrum_names(path)
     if n_data_columns is None:
         with open(path, "r") as fp:
             n_data_columns = len(fp.readline().strip().split()) - 1
@@ -1178,7 +1528,7 @@ def read_and_sort_output_data_file(path, input_names, n_data_columns=None, dtype
 
 
 def read_file_with_name_and_data(path, input_names, n_data_columns=None, dtype=float):
-    names = np.atleast_1d(np.loadtxt(path, usecols=(0, ), dtype=str))
+    names = read_ferre_spectrum_names(path)
     # Need the number of columns.
     if n_data_columns is None:
         with open(path, "r") as fp:
@@ -1215,7 +1565,7 @@ def read_output_parameter_file(pwd, control_kwds, input_names):
 
 def _read_output_parameter_file(path, n_dimensions, full_covariance, input_names):
     
-    names = np.atleast_1d(np.loadtxt(path, usecols=(0,), dtype=str))
+    names = read_ferre_spectrum_names(path)
 
     N_cols = 2 * n_dimensions + 3
     if full_covariance:
@@ -1313,9 +1663,14 @@ def get_processing_times(stdout_path_prefix, relative_path=None):
 
             si = 0
             expected_indices = -1 * np.ones((n_items, n_per_thread + 1), dtype=int)
+            # Also keep the (thread, position) of every object so we don't have to search for them later.
+            thread_index = np.empty(n_obj, dtype=int)
+            position_index = np.empty(n_obj, dtype=int)
             for i in range(n_items):
                 ei = n_per_thread + (1 if n_mod > i else 0)
                 expected_indices[i, :ei] = range(si, si + ei)
+                thread_index[si:si + ei] = i
+                position_index[si:si + ei] = np.arange(ei)
                 si += ei        
 
             # Find the obvious examples first.
@@ -1339,7 +1694,11 @@ def get_processing_times(stdout_path_prefix, relative_path=None):
                 next_object_match = re.match(next_object_pattern, process_stdout[ei:ei+oi])
                 if next_object_match:
                     next_object, = next_object_match.groups()
-                    i, j = np.where(expected_indices == (int(next_object) - 1 - 1)) # -1 for zero indexing, -1 to reference the object that was analysed
+                    index = int(next_object) - 1 - 1 # -1 for zero indexing, -1 to reference the object that was analysed
+                    if 0 <= index < n_obj:
+                        i, j = (thread_index[index], position_index[index])
+                    else:
+                        i, j = np.where(expected_indices == index)
                     t_elapsed_per_thread[i, j] = float(elapsed_time)
                 else:
                     # This usually happens when it is the last of an assigned set
@@ -1355,13 +1714,13 @@ def get_processing_times(stdout_path_prefix, relative_path=None):
                     row, col = (0, col + 1)
 
             # We want to compute the time taken per spectrum, not the time elapsed.
-            t_elapsed_per_spectrum = np.nan * np.ones(n_obj)
-            for i in range(n_obj):
-                (j, ), (k, ) = np.where(expected_indices == i)
-
-                # Subtract the load time from the first time per thread, or the time since last spectrum 
-                offset = t_elapsed_per_thread[j, k - 1] if k > 0 else t_load_grid
-                t_elapsed_per_spectrum[i] = t_elapsed_per_thread[j, k] - offset
+            # Subtract the load time from the first time per thread, or the time since last spectrum 
+            offset = np.where(
+                position_index > 0,
+                t_elapsed_per_thread[thread_index, np.clip(position_index - 1, 0, None)],
+                t_load_grid
+            )
+            t_elapsed_per_spectrum = t_elapsed_per_thread[thread_index, position_index] - offset
 
             return dict(
                 t_load_grid=t_load_grid,
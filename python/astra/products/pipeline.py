@@ -1,6 +1,7 @@
 """"Functions for creating pipeline products (e.g., astraStarASPCAP, astraVisitASPCAP)."""
 
 import os
+from operator import attrgetter
 from astropy.io import fits
 from peewee import JOIN
 from tqdm import tqdm
@@ -482,18 +483,18 @@ def _create_pipeline_product(
         if q.count() > 1:
             log.warning(f"More than 1 star-level result ({q.count()}) for {pipeline} and {spectrum_model} for source {source} (observatory={observatory}, instrument={instrument})")
         
+        accessors = _get_field_accessors(
+            fields, 
+            (
+                (pipeline_model, None), 
+                (spectrum_model, "__spectrum"), 
+                (Source, "__source")
+            )
+        )
         data = { name: [] for name in fields.keys() }
         for result in q.iterator():
-            for name, field in fields.items():
-                if field.model == pipeline_model:
-                    value = getattr(result, name)
-                elif field.model == spectrum_model:
-                    value = getattr(result.__spectrum, name)
-                elif field.model == Source:
-                    value = getattr(result.__source, name)
-                else:
-                    raise RuntimeError("AHH")
-
+            for name, field, get_value in accessors:
+                value = get_value(result)
                 if value is None:
                     value = get_fill_value(field, fill_values)
                 data[name].append(value)
@@ -719,20 +720,19 @@ old visit stuff:
         if q.count() > 1:
             log.warning(f"More than 1 star-level result ({q.count()}) for {pipeline} and {spectrum_model} for source {source} (observatory={observatory}, instrument={instrument})")
         
+        accessors = _get_field_accessors(
+            fields, 
+            (
+                (pipeline_model, None), 
+                (spectrum_model, "__spectrum"), 
+                (drp_spectrum_model, "__drp_spectrum"), 
+                (Source, "__source")
+            )
+        )
         data = { name: [] for name in fields.keys() }
         for result in q.iterator():
-            for name, field in fields.items():
-                if field.model == pipeline_model:
-                    value = getattr(result, name)
-                elif field.model == spectrum_model:
-                    value = getattr(result.__spectrum, name)
-                elif field.model == drp_spectrum_model:
-                    value = getattr(result.__drp_spectrum, name)
-                elif field.model == Source:
-                    value = getattr(result.__source, name)
-                else:
-                    raise RuntimeError("AHH")
-
+            for name, field, get_value in accessors:
+                value = get_value(result)
                 if value is None:
                     value = get_fill_value(field, fill_values)
                 data[name].append(value)
@@ -765,4 +765,34 @@ old visit stuff:
     hdu_list = fits.HDUList(hdus)
     hdu_list.writeto(path, overwrite=overwrite)
     return (path, hdu_list) if full_output else path
-'''
\ No newline at end of file
+'''
+
+
+def _unknown_model_getter(result):
+    raise RuntimeError("AHH")
+
+
+def _get_field_accessors(fields, related_models):
+    """
+    Return a list of `(name, field, getter)` tuples that fetch each field value from a query result.
+
+    Which (joined) model a field comes from is fixed for all rows, so we work this out once per
+    HDU rather than for every field of every row.
+
+    :param fields:
+        A dictionary of field names and fields.
+
+    :param related_models:
+        An ordered sequence of `(model, attr)` pairs, where `attr` is the attribute of the query result
+        that holds the joined model instance, or `None` if the fields belong to the result itself.
+    """
+    accessors = []
+    for name, field in fields.items():
+        for model, attr in related_models:
+            if field.model == model:
+                getter = attrgetter(name if attr is None else f"{attr}.{name}")
+                break
+        else:
+            getter = _unknown_model_getter
+        accessors.append((name, field, getter))
+    return accessors
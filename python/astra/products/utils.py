@@ -23,6 +23,7 @@ except:
     ArrayField = ...
 
 from collections import OrderedDict
+from functools import lru_cache
 
 from astropy.io import fits
 from tqdm import tqdm
@@ -187,6 +188,23 @@ def resolve_model(model_or_model_name):
     else:
         return model_or_model_name
 
+@lru_cache(maxsize=None)
+def _get_model_fields_and_pixel_arrays(model):
+    """
+    Return the `(name, field)` pairs of all fields and pixel arrays defined on a model.
+
+    This is called for every product we create, so the scan of the class namespace is
+    only done once per model.
+    """
+    fields = []
+    for name, field in model.__dict__.items():
+        if isinstance(field, FieldAccessor):
+            fields.append((name, model._meta.fields.get(name, field)))
+        elif isinstance(field, BasePixelArrayAccessor):
+            fields.append((name, field))
+    return tuple(fields)
+
+
 def get_fields_and_pixel_arrays(models, name_conflict_strategy=None, ignore_field_names=None):
     
     if name_conflict_strategy is None:
@@ -201,16 +219,10 @@ def get_fields_and_pixel_arrays(models, name_conflict_strategy=None, ignore_fiel
 
     fields = OrderedDict([])
     for model in models:
-        for name, field in model.__dict__.items():
-            if (
-                (ignore_field_names is not None and name in ignore_field_names)
-            or  (not isinstance(field, (FieldAccessor, BasePixelArrayAccessor)))
-            ):
+        for name, field in _get_model_fields_and_pixel_arrays(model):
+            if ignore_field_names is not None and name in ignore_field_names:
                 continue
 
-            if isinstance(field, FieldAccessor):
-                field = model._meta.fields.get(name, field)
-
             if name in fields:
                 name_conflict_strategy(fields, name, field, model)                
             else:
@@ -107,7 +107,7 @@ class Timer(object):
                     # Note the time it took to analyse this object using the named attribute, 
                     # but don't assume it exists.
                     setattr(item, self.attr_t_elapsed, interval)
-                except:
+                except AttributeError:
                     warnings.warn(f"Could not store elapsed time on attribute name `{self.attr_t_elapsed}`")
 
         self._time_paused = 0
@@ -115,13 +115,16 @@ class Timer(object):
         return item
 
     def add_overheads(self, items):
+        if self.attr_t_elapsed is None:
+            return None
         o = self.mean_overhead_per_result
         for item in items:
             try:
                 v = getattr(item, self.attr_t_elapsed, 0)
                 setattr(item, self.attr_t_elapsed, v + o)
-                setattr(item, self.attr_t_overhead, o)
-            except:
+                if self.attr_t_overhead is not None:
+                    setattr(item, self.attr_t_overhead, o)
+            except (AttributeError, TypeError):
                 continue
         return None
 
@@ -147,12 +150,6 @@ class Timer(object):
             self._n_check_points += 1
         return is_check_point
 
-    # Make it so we can use `with timer.pause(): ... `
-    def pause(self):
-        def callback(time_paused):
-            self._time_paused += time_paused
-        return self.__class__([], None, callback=callback)
-    
 
 def callable(input_callable):
     if isinstance(input_callable, str):
@@ -190,8 +187,16 @@ def dict_to_list(DL):
 def list_to_dict(LD):
     """
     Convert a list of dictionaries to a dictionary with lists as values.
+
+    This makes a single pass over `LD`, so it can also be any iterable of dictionaries.
     """
-    return {k: [dic[k] for dic in LD] for k in LD[0]}
+    DL = None
+    for dic in LD:
+        if DL is None:
+            DL = {k: [] for k in dic}
+        for k, values in DL.items():
+            values.append(dic[k])
+    return DL or {}
 
 
 def flatten(struct):